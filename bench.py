@@ -0,0 +1,181 @@
+################################################################################
+#
+# Benchmarks for pmdive module
+# Copyright (C) 2014 Egor Puzanov.
+#
+# This program can be used under the GNU General Public License version 2
+# You can find full information here: http://www.gnu.org/licenses/gpl-2.0.html
+#
+################################################################################
+
+__doc__="""Benchmarks for the single stages of pattern generation.
+
+    Usage Example:
+    python bench.py --repeat=20 --save=baseline.json
+    python bench.py --compare=baseline.json --threshold=0.2
+    """
+
+import json
+import os
+import resource
+import StringIO
+import timeit
+import pmdive
+
+DEVICES = ('132.6x65.5x6.18', '150x75x8', '120x60x10')
+SCREEN_MIDDLES = (None, 60)
+PAGES = (None, 1, 2)
+NOSCRIPTS = (None, True)
+STAGES = ('validation', 'getPoints', 'getPoints cached', 'getSymbols',
+    'buildSVG', 'toprettyxml', 'buildSVG stream')
+
+def getGrid():
+    """Representative parameter grid as list of (name, value) pair lists."""
+    grid = []
+    for dimensions in DEVICES:
+        for middle in SCREEN_MIDDLES:
+            for page in PAGES:
+                for noscript in NOSCRIPTS:
+                    grid.append([('dimensions', dimensions),
+                        ('device_screen_middle', middle), ('pd', 64),
+                        ('page', page), ('noscript', noscript)])
+    return grid
+
+def makeDive(params):
+    pd = pmdive.pmDive()
+    for name, value in params:
+        setattr(pd, name, value)
+    return pd
+
+def getStages(grid):
+    """Return {stage name: function}. Every function processes the whole grid
+    once."""
+    dives = [makeDive(params) for params in grid]
+    points = [(pd, pd.calcPoints('Right')) for pd in dives]
+    docs = [pd.buildSVG().doc for pd in dives]
+
+    def validation():
+        for params in grid:
+            makeDive(params)
+
+    def calcPoints():
+        for pd in dives:
+            pd.calcPoints('Right')
+            pd.calcPoints('Left')
+
+    def getPoints():
+        for pd in dives:
+            pd.getPoints('Right')
+            pd.getPoints('Left')
+
+    def getSymbols():
+        svg = pmdive.SVG()
+        for pd, rpoints in points:
+            pd.getSymbols(svg, rpoints)
+
+    def buildSVG():
+        for pd in dives:
+            pd.buildSVG()
+
+    def toprettyxml():
+        for doc in docs:
+            doc.toprettyxml()
+
+    def streamSVG():
+        for pd in dives:
+            pd.buildSVG(StringIO.StringIO())
+
+    return {'validation':validation, 'getPoints':calcPoints,
+        'getPoints cached':getPoints, 'getSymbols':getSymbols,
+        'buildSVG':buildSVG, 'toprettyxml':toprettyxml,
+        'buildSVG stream':streamSVG}
+
+def maxrss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def stageMemory(stage):
+    """Run stage once in a forked process and return the growth of its peak
+    resident set size in kB, so the stages do not influence each other."""
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(read)
+            start = maxrss()
+            stage()
+            os.write(write, str(maxrss() - start))
+        finally:
+            os._exit(0)
+    os.close(write)
+    f = os.fdopen(read)
+    memory = f.read()
+    f.close()
+    os.waitpid(pid, 0)
+    return int(memory)
+
+def run(repeat=10):
+    """Run all stages and return {stage: {'ops': ..., 'memory': ...}}, where
+    ops is the number of processed parameter sets per second and memory the
+    peak resident set size growth in kB of one run of the stage."""
+    grid = getGrid()
+    stages = getStages(grid)
+    results = {}
+    for name in STAGES:
+        best = min(timeit.repeat(stages[name], number=1, repeat=repeat))
+        results[name] = {'ops':len(grid)/best,
+            'memory':stageMemory(stages[name])}
+    return results
+
+def compare(results, baseline, threshold=0.2, memory=1024):
+    """Return list of stages which are slower than baseline by more than
+    threshold (relative throughput loss) or need more memory than baseline
+    by more than threshold and more than memory kB."""
+    slower = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        result, base = results[name], baseline[name]
+        if (result['ops'] < base['ops'] * (1 - threshold) or
+                'memory' in base and result['memory'] - base['memory'] >
+                max(base['memory'] * threshold, memory)):
+            slower.append(name)
+    return slower
+
+def report(results, baseline=None):
+    for name in STAGES:
+        result = results[name]
+        line = '%-18s %10.1f ops/s %8.1f us/op %8d kB'%(name, result['ops'],
+            1e6/result['ops'], result['memory'])
+        if baseline and name in baseline:
+            line += ' %+6.1f%%'%((result['ops']/baseline[name]['ops']-1)*100)
+        print line
+
+if __name__ == '__main__':
+    import sys, getopt
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "",
+            ['help', 'repeat=', 'save=', 'compare=', 'threshold='])
+    except getopt.GetoptError:
+        print __doc__
+        sys.exit(2)
+    options = dict([(opt[2:], arg) for opt, arg in opts])
+    if 'help' in options:
+        print __doc__
+        sys.exit()
+    results = run(int(options.get('repeat', 10)))
+    baseline = None
+    if 'compare' in options:
+        f = open(options['compare'])
+        baseline = json.load(f)
+        f.close()
+    report(results, baseline)
+    if 'save' in options:
+        f = open(options['save'], 'w')
+        json.dump(results, f, indent=1, sort_keys=True)
+        f.close()
+    if baseline:
+        slower = compare(results, baseline,
+            float(options.get('threshold', 0.2)))
+        if slower:
+            print 'Slower or larger than baseline: %s'%', '.join(slower)
+            sys.exit(1)
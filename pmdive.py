@@ -15,9 +15,17 @@ __doc__="""This module generate pattern for paper model of OpenDive
     Usage Example:
     python pmdive.py --page_width=210 --pupillary_distance=70 --noscript output.svg
     """
+__version__ = '1.1'
 
 from xml.dom import minidom
+import array
+import gc
 import math
+import os
+import threading
+import timeit
+from collections import OrderedDict
+from contextlib import contextmanager
 STYLE="""
 polyline {
     fill: none;
@@ -40,65 +48,66 @@ line {
     stroke-width: 20;
     stroke-dasharray: 200,200
 }
+path.cut {
+    fill: none;
+    stroke: black;
+    stroke-width: 50
+}
+path.fold {
+    fill: none;
+    stroke: black;
+    stroke-width: 20;
+    stroke-dasharray: 200,200
+}
 """
 SCRIPT="""
+var XLINK = "http://www.w3.org/1999/xlink";
 var params = { };
 var svgparams = document.getElementsByTagName( "param" );
 for (var i = 0; i < svgparams.length; ++i) {
-    params[ svgparams[i].attributes["name"].value ] = svgparams[i].attributes["value"].value;
-}
-
-var actions = new function () {
-    this.list = [];
-    this.splice = function (s, l, action) {
-        if (this.list.indexOf(action) < 0) {
-            this.list.splice(s, l, action);
-        }
-    };
-    this.push = function (action) {
-        if (this.list.indexOf(action) < 0) {
-            this.list.push(action);
-        }
-    };
-    this.join = function (separator) {
-        return this.list.join(separator);
-    };
+    params[ svgparams[i].getAttribute( "name" ) ] = svgparams[i].getAttribute( "value" );
 }
 
+var actions = { };
 if (location.href.indexOf( '?' ) != -1) {
     location.href.split( '?' )[1].split(/&|;/).forEach(
         function( i ) {
             var varval = i.split( '=' );
             switch (unescape(varval[0])) {
                 case "pd":
-                    actions.push('updateCircles');
                     varval[0] = 'pupillary_distance';
+                    actions.circles = true;
                     break;
                 case "dimensions":
                     var dimensions = varval[1].toLowerCase().split('x');
                     params[ 'device_width' ] = unescape(dimensions[1]);
                     params[ 'device_depth' ] = unescape(dimensions[2]);
+                    params[ 'device_screen_middle' ] = '';
                     varval = ['device_height', dimensions[0]];
-                    actions.splice(0, 0, 'updateSymbols');
+                    actions.symbols = true;
                     break;
                 case "page_width":
-                    actions.splice(0, 0, 'updateSymbols');
-                    actions.push('updateViewBox');
+                    actions.viewBox = true;
+                    actions.pages = true;
+                    break;
+                case "page_height": actions.viewBox = true; break;
+                case "device_height":
+                    params[ 'device_screen_middle' ] = '';
+                    actions.symbols = true;
                     break;
-                case "page_height":
-                    actions.splice(0, 0, 'updateSymbols');
-                    actions.push('updateViewBox');
+                case "device_width":
+                case "device_depth":
+                case "device_screen_middle":
+                case "lens_focal_length":
+                    actions.symbols = true;
                     break;
-                case "device_width": actions.splice(0, 0, 'updateSymbols'); break;
-                case "device_height": actions.splice(0, 0, 'updateSymbols'); break;
-                case "device_depth": actions.splice(0, 0, 'updateSymbols'); break;
-                case "device_screen_middle": actions.splice(0, 0, 'updateSymbols'); break;
-                case "lens_focal_length": actions.splice(0, 0, 'updateSymbols'); break;
-                case "lens_diameter": actions.push('updateCircles'); break;
-                case "pupillary_distance": actions.push('updateCircles'); break;
-                case "strap_width": actions.push('updateStrapWidth'); break;
-                case "page": actions.push('updatePages'); break;
-                case "logo": actions.push('updateLogo'); break;
+                case "lens_diameter":
+                case "pupillary_distance":
+                    actions.circles = true;
+                    break;
+                case "strap_width": actions.rects = true; break;
+                case "page": actions.pages = true; break;
+                case "logo": actions.logo = true; break;
                 default: break;
             }
             params[ unescape(varval[0]) ] = unescape(varval[1]);
@@ -114,6 +123,14 @@ function point(x, y) {
     }
 }
 
+function round(value) {
+    return value < 0 ? -Math.round(-value) : Math.round(value);
+}
+
+function trunc(value) {
+    return value < 0 ? Math.ceil(value) : Math.floor(value);
+}
+
 function getScreenMiddle(params, side) {
     if (params.device_screen_middle == '') {
         return params.device_height/2;
@@ -121,28 +138,29 @@ function getScreenMiddle(params, side) {
     if (side == 'Right') {
         return params.device_height - params.device_screen_middle;
     } else {
-        return params.device_screen_middle;
+        return params.device_screen_middle/1;
     }
 }
 
 function getPoints(params, side) {
     var points = [];
     var last = null;
-    points.push(last = new point(1300, Math.round(Math.sqrt(Math.pow(params.device_width / 2 - 25, 2) + Math.pow(params.lens_focal_length, 2)) * 100) + 9000))
+    var middle = getScreenMiddle(params, side);
+    points.push(last = new point(1300, round(Math.sqrt(Math.pow(params.device_width / 2 - 25, 2) + Math.pow(params.lens_focal_length, 2)) * 100) + 9000))
     points.splice(0, 0, new point(0, last.y - 1200));
-    points.push(last = new point(Math.round(getScreenMiddle(params, side) * 100 + 100), last.y));
+    points.push(last = new point(trunc(middle * 100 + 100), last.y));
     points.push(last = new point(5800, 9000));
-    points.push(last = new point(Math.round(Math.sqrt(Math.pow(getScreenMiddle(params, side) - 58, 2) + Math.pow(params.lens_focal_length, 2)) * 100) + 5800, Math.round((params.device_width / 2 - 25) * 100) + 9000));
-    angle = Math.atan((last.y -9000) / (last.x - 5800.0)) + Math.atan(1);
-    angle1 = Math.atan((points[2].y - 9000) / (points[2].x - 5800.0));
+    points.push(last = new point(round(Math.sqrt(Math.pow(middle - 58, 2) + Math.pow(params.lens_focal_length, 2)) * 100) + 5800, round((params.device_width / 2 - 25) * 100) + 9000));
+    var angle = Math.atan((last.y -9000) / (last.x - 5800.0)) + Math.atan(1);
+    var angle1 = Math.atan((points[2].y - 9000) / (points[2].x - 5800.0));
     if (Math.abs(angle1) > angle) {
         angle1 = angle;
     }
-    points.splice(4, 0, new point(Math.round(5800 + Math.abs(Math.cos(angle1) * 1414)), Math.round(Math.abs(Math.sin(angle1) * 1414)) + 9000));
-    points.splice(5, 0, new point(points[5].x - Math.round(Math.abs(Math.sin(angle - Math.atan(1)) * 1000)), points[5].y + Math.round(Math.abs(Math.cos(angle - Math.atan(1)) * 1000))));
+    points.splice(4, 0, new point(round(5800 + Math.abs(Math.cos(angle1) * 1414)), round(Math.abs(Math.sin(angle1) * 1414)) + 9000));
+    points.splice(5, 0, new point(points[5].x - round(Math.abs(Math.sin(angle - Math.atan(1)) * 1000)), points[5].y + round(Math.abs(Math.cos(angle - Math.atan(1)) * 1000))));
     points.push(last = new point(last.x, last.y + 1000));
     points.push(last = new point(last.x + 1000, last.y));
-    points.push(last = new point(last.x, last.y - (params.device_width * 100) - 2000));
+    points.push(last = new point(last.x, last.y - trunc(params.device_width * 100) - 2000));
     points.push(last = new point(last.x - 1000, last.y));
     points.push(last = new point(last.x, last.y + 1000));
     points.push(last = new point(points[5].x, 13000 - points[5].y));
@@ -156,205 +174,162 @@ function getPoints(params, side) {
     points.push(last = new point(5600, 0));
     points.push(last = new point(5600, 4000));
     points.push(last = new point(5800, 4000));
-    points.push(last = new point(Math.round(getScreenMiddle(params, side) * 100 + 100), Math.round(Math.sqrt(Math.pow(params.device_width / 2 - 25, 2) + Math.pow(params.lens_focal_length - 1, 2)) * 100) + last.y));
-    points.push(last = new point(last.x + Math.round(params.device_depth * 100 + 100), last.y));
-    points.push(last = new point(last.x, last.y + Math.round(params.device_depth * 100 + 100)));
+    points.push(last = new point(trunc(middle * 100 + 100), round(Math.sqrt(Math.pow(params.device_width / 2 - 25, 2) + Math.pow(params.lens_focal_length - 1, 2)) * 100) + last.y));
+    points.push(last = new point(last.x + round(params.device_depth * 100 + 100), last.y));
+    points.push(last = new point(last.x, last.y + round(params.device_depth * 100 + 100)));
     points.push(last = new point(points[19].x, last.y));
     points.push(last = new point(points[20].x, last.y));
-    points.push(last = new point(last.x + Math.round(Math.sqrt(Math.pow(getScreenMiddle(params, side) - 58, 2) + Math.pow(params.lens_focal_length, 2)) * 100), Math.round((params.device_width / 2 - 25) * 100) + last.y));
+    points.push(last = new point(last.x + round(Math.sqrt(Math.pow(middle - 58, 2) + Math.pow(params.lens_focal_length, 2)) * 100), round((params.device_width / 2 - 25) * 100) + last.y));
     points.push(last = new point(last.x, last.y + 5000));
-    points.push(last = new point(points[23].x, points[23].y + Math.round(params.device_width * 100 + 100)));
+    points.push(last = new point(points[23].x, points[23].y + round(params.device_width * 100 + 100)));
     points.push(new point(1300, last.y));
     points.push(last = new point(0, last.y - 1200));
     return points;
 }
 
-function updateSymbols(params) {
-    var rpoints = getPoints(params, 'Right');
-    if (params.device_screen_middle == "" || params.device_screen_middle == params.device_height / 2) {
-        var lpoints = rpoints;
-    } else {
-        var lpoints = getPoints(params, 'Left');
+var elements = { };
+
+function getElements(id) {
+    if (!(id in elements)) {
+        var node = document.getElementById( id );
+        var el = elements[id] = { node: node };
+        ["polyline", "circle", "rect", "line", "image"].forEach(
+            function( tag ) {
+                el[tag] = Array.prototype.slice.call(node.getElementsByTagName( tag ));
+            }
+        )
     }
-    var nl = document.getElementsByTagName( "polyline" );
-    nl[0].setAttribute("points", rpoints.slice(0,17).join(' '));
-    nl[2].setAttribute("points", rpoints.slice(16).join(' '));
-    nl[3].setAttribute("points", '0,400 800,400 1800,4000 1800,' + rpoints[19].y + ' 0,' +  rpoints[19].y);
-    nl[4].setAttribute("points", lpoints.slice(0,17).join(' '));
-    nl[6].setAttribute("points", lpoints.slice(16).join(' '));
-    nl[7].setAttribute("points", '0,400 800,400 1800,4000 1800,' + lpoints[19].y + ' 0,' +  lpoints[19].y);
-    nl = document.getElementsByTagName( "rect" );
-    var strap_width = params.strap_width * 100 + 200;
-    var y_int=Math.round(6500 - (strap_width / 2));
-    for (var i = 0; i < nl.length; ++i) {
-        nl[i].setAttribute("y", y_int);
-        nl[i].setAttribute("height", strap_width);
+    return elements[id];
+}
+
+function setLines(updates, nodes, lines) {
+    for (var i = 0; i < lines.length; ++i) {
+        updates.push([nodes[i], "x1", lines[i][0]], [nodes[i], "y1", lines[i][1]],
+                     [nodes[i], "x2", lines[i][2]], [nodes[i], "y2", lines[i][3]]);
     }
-    y_int = Math.round((rpoints[25].y - rpoints[24].y - strap_width)/2) + rpoints[24].y;
-    nl[3].setAttribute("x", rpoints[24].x - 1200);
-    nl[3].setAttribute("y", y_int);
-    nl[4].setAttribute("x", rpoints[24].x - 2100);
-    nl[4].setAttribute("y", y_int);
-    nl[8].setAttribute("x", lpoints[24].x - 1200);
-    nl[8].setAttribute("y", y_int);
-    nl[9].setAttribute("x", lpoints[24].x - 2100);
-    nl[9].setAttribute("y", y_int);
-    nl = document.getElementsByTagName( "line" );
-    nl[1].setAttribute("x1", rpoints[6].x);
-    nl[1].setAttribute("y1", rpoints[6].y - 100);
-    nl[1].setAttribute("x2", rpoints[8].x);
-    nl[1].setAttribute("y2", rpoints[6].y - 100);
-    nl[2].setAttribute("x1", rpoints[3].x);
-    nl[2].setAttribute("y1", rpoints[3].y);
-    nl[2].setAttribute("x2", rpoints[6].x);
-    nl[2].setAttribute("y2", rpoints[6].y);
-    nl[3].setAttribute("x1", rpoints[6].x);
-    nl[3].setAttribute("y1", rpoints[6].y);
-    nl[3].setAttribute("x2", rpoints[11].x);
-    nl[3].setAttribute("y2", rpoints[11].y);
-    nl[4].setAttribute("x1", rpoints[11].x);
-    nl[4].setAttribute("x2", rpoints[11].x);
-    nl[4].setAttribute("y2", rpoints[11].y);
-    nl[5].setAttribute("x1", rpoints[11].x);
-    nl[5].setAttribute("y1", rpoints[11].y + 100);
-    nl[5].setAttribute("x2", rpoints[8].x);
-    nl[5].setAttribute("y2", rpoints[11].y + 100);
-    nl[8].setAttribute("x2", rpoints[11].x);
-    nl[8].setAttribute("y2", rpoints[11].y);
-    nl[12].setAttribute("y1", rpoints[19].y);
-    nl[12].setAttribute("x2", rpoints[19].x);
-    nl[12].setAttribute("y2", rpoints[19].y);
-    nl[13].setAttribute("x1", rpoints[19].x);
-    nl[13].setAttribute("y1", rpoints[19].y);
-    nl[13].setAttribute("x2", rpoints[22].x);
-    nl[13].setAttribute("y2", rpoints[22].y);
-    nl[14].setAttribute("y1", rpoints[22].y);
-    nl[14].setAttribute("x2", rpoints[22].x);
-    nl[14].setAttribute("y2", rpoints[22].y);
-    nl[15].setAttribute("x1", rpoints[22].x + 100);
-    nl[15].setAttribute("y1", rpoints[22].y);
-    nl[15].setAttribute("x2", rpoints[22].x + 100);
-    nl[15].setAttribute("y2", rpoints[26].y);
-    nl[16].setAttribute("x1", rpoints[23].x);
-    nl[16].setAttribute("y1", rpoints[23].y);
-    nl[16].setAttribute("x2", rpoints[23].x);
-    nl[16].setAttribute("y2", rpoints[26].y);
-    nl[18].setAttribute("x1", lpoints[6].x);
-    nl[18].setAttribute("y1", lpoints[6].y - 100);
-    nl[18].setAttribute("x2", lpoints[8].x);
-    nl[18].setAttribute("y2", lpoints[6].y - 100);
-    nl[19].setAttribute("x1", lpoints[3].x);
-    nl[19].setAttribute("y1", lpoints[3].y);
-    nl[19].setAttribute("x2", lpoints[6].x);
-    nl[19].setAttribute("y2", lpoints[6].y);
-    nl[20].setAttribute("x1", lpoints[6].x);
-    nl[20].setAttribute("y1", lpoints[6].y);
-    nl[20].setAttribute("x2", lpoints[11].x);
-    nl[20].setAttribute("y2", lpoints[11].y);
-    nl[21].setAttribute("x1", lpoints[11].x);
-    nl[21].setAttribute("x2", lpoints[11].x);
-    nl[21].setAttribute("y2", lpoints[11].y);
-    nl[22].setAttribute("x1", lpoints[11].x);
-    nl[22].setAttribute("y1", lpoints[11].y + 100);
-    nl[22].setAttribute("x2", lpoints[8].x);
-    nl[22].setAttribute("y2", lpoints[11].y + 100);
-    nl[25].setAttribute("x2", lpoints[11].x);
-    nl[25].setAttribute("y2", lpoints[11].y);
-    nl[29].setAttribute("y1", lpoints[19].y);
-    nl[29].setAttribute("x2", lpoints[19].x);
-    nl[29].setAttribute("y2", lpoints[19].y);
-    nl[30].setAttribute("x1", lpoints[19].x);
-    nl[30].setAttribute("y1", lpoints[19].y);
-    nl[30].setAttribute("x2", lpoints[22].x);
-    nl[30].setAttribute("y2", lpoints[22].y);
-    nl[31].setAttribute("y1", lpoints[22].y);
-    nl[31].setAttribute("x2", lpoints[22].x);
-    nl[31].setAttribute("y2", lpoints[22].y);
-    nl[32].setAttribute("x1", lpoints[22].x + 100);
-    nl[32].setAttribute("y1", lpoints[22].y);
-    nl[32].setAttribute("x2", lpoints[22].x + 100);
-    nl[32].setAttribute("y2", lpoints[26].y);
-    nl[33].setAttribute("x1", lpoints[23].x);
-    nl[33].setAttribute("y1", lpoints[23].y);
-    nl[33].setAttribute("x2", lpoints[23].x);
-    nl[33].setAttribute("y2", lpoints[26].y);
-    var trx = (Math.max(rpoints[8].x, rpoints[24].x) + Math.max(lpoints[8].x, lpoints[24].x)) / 2 + 50;
-    if (trx > (params.page_width * 50)) {
-        trx = Math.round(params.page_width * 50);
+}
+
+function updateSymbols(updates, side, p) {
+    var up = getElements(side + "UpSide");
+    var down = getElements(side + "DownSide");
+    updates.push([up.polyline[0], "points", p.slice(0, 17).join(' ')]);
+    updates.push([down.polyline[0], "points", p.slice(16).join(' ')]);
+    updates.push([down.polyline[1], "points", '0,400 800,400 1800,4000 1800,' + p[19].y + ' 0,' + p[19].y]);
+    setLines(updates, up.line, [
+        [0, 9000, 5800, 9000],
+        [p[6].x, p[6].y - 100, p[8].x, p[6].y - 100],
+        [p[3].x, p[3].y, p[6].x, p[6].y],
+        [p[6].x, p[6].y, p[11].x, p[11].y],
+        [p[11].x, 9000, p[11].x, p[11].y],
+        [p[11].x, p[11].y + 100, p[8].x, p[11].y + 100],
+        [5800, 9000, 5800, 4000],
+        [1800, 4000, 5800, 4000],
+        [5800, 4000, p[11].x, p[11].y],
+        [0, 0, 5600, 0]]);
+    setLines(updates, down.line, [
+        [0, 0, 5600, 0],
+        [1800, 4000, 5800, 4000],
+        [1800, p[19].y, p[19].x, p[19].y],
+        [p[19].x, p[19].y, p[22].x, p[22].y],
+        [0, p[22].y, p[22].x, p[22].y],
+        [p[22].x + 100, p[22].y, p[22].x + 100, p[26].y],
+        [p[23].x, p[23].y, p[23].x, p[26].y]]);
+}
+
+function updateRects(updates, side, p) {
+    var up = getElements(side + "UpSide");
+    var down = getElements(side + "DownSide");
+    var strap_width = trunc(params.strap_width * 100 + 200);
+    var y = 6500 - Math.floor(strap_width / 2);
+    for (var i = 0; i < up.rect.length; ++i) {
+        updates.push([up.rect[i], "y", y], [up.rect[i], "height", strap_width]);
     }
-    var pages = document.getElementsByTagName( "g" );
-    for (var i = 0; i < 2; ++i) {
-        var tr = pages[i].getAttribute( "transform" ).split(",")[1];
-        pages[i].setAttribute( "transform", "translate(" + trx + "," + tr );
+    y = Math.floor((p[25].y - p[24].y - strap_width) / 2) + p[24].y;
+    for (var i = 0; i < down.rect.length; ++i) {
+        updates.push([down.rect[i], "x", p[24].x - [1200, 2100][i]],
+                     [down.rect[i], "y", y], [down.rect[i], "height", strap_width]);
     }
-    var nl = document.getElementsByTagName( "image" );
-    nl[0].setAttribute( "height", params.device_width * 100 + 100 );
-    nl[0].setAttribute( "width", params.device_height * 100 + 200 );
-    nl[0].setAttribute( "transform", 'translate(' + rpoints[19].x + ',' + rpoints[26].y + ') scale(-1,-1)');
 }
 
-function updateViewBox(params) {
-    var svg = document.getElementsByTagName( "svg" )[0];
-    svg.setAttribute( "width", params.page_width + "mm" );
-    svg.setAttribute( "height", params.page_height + "mm" );
-    svg.setAttribute( "viewBox", "0 0 " +  (params.page_width * 100) + " " + (params.page_height * 100));
-};
-
-function updateCircles (params) {
-    var r = params.lens_diameter * 50 - 200;
-    var cx = params.pupillary_distance * 50; 
-    var nl = document.getElementsByTagName( "circle" );
-    for (var i = 0; i < nl.length; ++i) {
-        nl[i].setAttribute( "cx", cx );
-        if (i == 1 || i == 4) {
-            nl[i].setAttribute( "r", r + 200 );
-        } else {
-            nl[i].setAttribute( "r", r );
-        }
-    }
+function updateCircles(updates, side) {
+    var cx = round(params.pupillary_distance * 50);
+    var r = round(params.lens_diameter * 50);
+    var up = getElements(side + "UpSide").circle;
+    var down = getElements(side + "DownSide").circle;
+    updates.push([up[0], "cx", cx], [up[0], "r", r - 200],
+                 [up[1], "cx", cx], [up[1], "r", r],
+                 [down[0], "cx", cx], [down[0], "r", r - 200]);
 }
 
-function updateStrapWidth (params) {
-    var strap_width = params.strap_width * 100 + 200;
-    var nl = document.getElementsByTagName( "rect" );
-    var yu = Math.round(6500 - strap_width/2);
-    var yd = Math.round(nl[3].getAttribute( "y" )/1 + nl[3].getAttribute( "height" )/2 - strap_width/2);
-    for (var i = 0; i < nl.length; ++i) {
-        if ( [3,4,8,9].indexOf(i) < 0 ) {
-            nl[i].setAttribute( "y", yu );
-        } else {
-            nl[i].setAttribute( "y", yd );
-        }
-        nl[i].setAttribute( "height", strap_width );
+function updatePages(updates, rpoints, lpoints) {
+    var x = Math.floor((Math.max(rpoints[8].x, rpoints[24].x) + Math.max(lpoints[8].x, lpoints[24].x)) / 2) + 50;
+    if (x > params.page_width * 50) {
+        x = round(params.page_width * 50) + 50;
     }
+    var y = rpoints[1].y + 50;
+    updates.push([getElements("page1").node, "visibility", params.page == 2 ? "hidden" : "visible"],
+                 [getElements("page1").node, "transform", "translate(" + x + "," + y + ")"],
+                 [getElements("page2").node, "visibility", params.page == 1 ? "hidden" : "visible"],
+                 [getElements("page2").node, "transform", "translate(" + x + "," + (params.page == 2 ? 50 : y) + ")"]);
 }
 
-function updateLogo (params) {
-    var nl = document.getElementsByTagName( "image" );
-    nl[0].setAttribute( "xlink:href", params.logo );
+function updateImage(updates, rpoints) {
+    var image = getElements("page2").image[0];
+    updates.push([image, "height", trunc(params.device_width * 100 + 100)],
+                 [image, "width", trunc(params.device_height * 100 + 200)],
+                 [image, "transform", "translate(" + rpoints[19].x + "," + rpoints[26].y + ") scale(-1,-1)"]);
 }
 
-function updatePages(params) {
-    var pages = document.getElementsByTagName( "g" );
-    if (params.page == "1") {
-        pages[0].setAttribute("visibility", "visible");
-        pages[1].setAttribute("visibility", "hidden");
-    } else if (params.page == "2") {
-        pages[0].setAttribute("visibility", "hidden");
-        pages[1].setAttribute("visibility", "visible");
-        var tr = pages[1].getAttribute("transform").split(",")[0] + ",50)";
-        pages[1].setAttribute("transform", tr);
-    } else {
-        pages[0].setAttribute("visibility", "visible");
-        pages[1].setAttribute("visibility", "visible");
-        tr = pages[0].getAttribute("transform");
-        pages[1].setAttribute("transform", tr);
-    }
+function updateViewBox(updates) {
+    var svg = document.documentElement;
+    updates.push([svg, "width", params.page_width + "mm"],
+                 [svg, "height", params.page_height + "mm"],
+                 [svg, "viewBox", "0 0 " + (params.page_width * 100) + " " + (params.page_height * 100)]);
 }
 
-for (var action in actions.list) {
-    eval(actions.list[action])(params);
+function update() {
+    var updates = [];
+    if (actions.symbols || actions.rects || actions.pages) {
+        var rpoints = getPoints(params, 'Right');
+        var lpoints = rpoints;
+        if (getScreenMiddle(params, 'Right') != params.device_height / 2) {
+            lpoints = getPoints(params, 'Left');
+        }
+    }
+    if (actions.symbols) {
+        updateSymbols(updates, 'Right', rpoints);
+        updateSymbols(updates, 'Left', lpoints);
+        updateImage(updates, rpoints);
+        actions.rects = actions.pages = true;
+    }
+    if (actions.rects) {
+        updateRects(updates, 'Right', rpoints);
+        updateRects(updates, 'Left', lpoints);
+    }
+    if (actions.circles) {
+        updateCircles(updates, 'Right');
+        updateCircles(updates, 'Left');
+    }
+    if (actions.pages) {
+        updatePages(updates, rpoints, lpoints);
+    }
+    if (actions.logo) {
+        updates.push([getElements("page2").image[0], "xlink:href", params.logo]);
+    }
+    if (actions.viewBox) {
+        updateViewBox(updates);
+    }
+    for (var i = 0; i < updates.length; ++i) {
+        var u = updates[i];
+        if (u[1].indexOf("xlink:") == 0) {
+            u[0].setAttributeNS(XLINK, u[1], u[2]);
+        } else {
+            u[0].setAttribute(u[1], u[2]);
+        }
+    }
 }
+
+update();
 """
 
 class SVG(object):
@@ -366,13 +341,16 @@ class SVG(object):
         self.doc = imp.createDocument('http://www.w3.org/2000/svg', 'svg', dt)
         self.root = self.doc.getElementsByTagName('svg')[0]
         self.root.setAttribute('version', '1.1')
-        self.root.setAttribute('width', '%smm'%page_width)
-        self.root.setAttribute('height', '%smm'%page_height)
-        self.root.setAttribute('viewBox', '0 0 %s00 %s00'%(page_width, page_height))
+        self.setPageSize(page_width, page_height)
         self.root.setAttribute('preserveAspectRatio', 'xMinYMin slice')
         self.root.setAttribute('xmlns', 'http://www.w3.org/2000/svg')
         self.root.setAttribute('xmlns:xlink', 'http://www.w3.org/1999/xlink')
 
+    def setPageSize(self, page_width, page_height):
+        self.root.setAttribute('width', '%smm'%page_width)
+        self.root.setAttribute('height', '%smm'%page_height)
+        self.root.setAttribute('viewBox', '0 0 %s00 %s00'%(page_width, page_height))
+
     def setAttributes(self, node, attrs):
         for (key, value) in attrs.iteritems():
             node.setAttribute(key, value)
@@ -393,6 +371,12 @@ class SVG(object):
         tn = self.doc.createTextNode(data)
         el.appendChild(tn)
 
+    def cdata(self, node, data):
+        node.appendChild(self.doc.createCDATASection(data))
+
+    def fragment(self, parent, build):
+        build(self, parent)
+
     def hidePage(self, page=None):
         pages = self.doc.getElementsByTagName("g")
         if page == None:
@@ -410,7 +394,1399 @@ class SVG(object):
             pages[1].setAttribute("transform", tr)
 
 
-class pmDive(object):
+def buildHead(svg, parent):
+    svg.textNode('title', "Poor Man's Dive", parent)
+    svg.textNode('desc', "Poor Man's Dive is a pattern for paper model of OpenDive (http://www.durovis.com/opendive.html) compatible 3D glasses.", parent)
+    metadata = svg.element('metadata', parent)
+    rdfRDF = svg.element('rdf:RDF', metadata, attributes={"xmlns:rdf":"http://www.w3.org/1999/02/22-rdf-syntax-ns#","xmlns:cc":"http://creativecommons.org/ns#"})
+    ccWork = svg.element('cc:Work', rdfRDF, attributes={"xmlns:dc":"http://purl.org/dc/elements/1.1/","rdf:about":""})
+    svg.textNode('dc:format', "image/svg+xml", ccWork)
+    svg.element('dc:type', ccWork, attributes={"rdf:resource":"http://purl.org/dc/dcmitype/StillImage"})
+    svg.textNode('dc:creator', "Egor Puzanov", ccWork)
+    svg.element('dc:license', ccWork, attributes={"rdf:resource":"http://creativecommons.org/licenses/by-sa/3.0/"})
+    svg.element('cc:license', ccWork, attributes={"rdf:resource":"http://creativecommons.org/licenses/by-sa/3.0/"})
+    svg.textNode('cc:attributionName', "Egor Puzanov", ccWork)
+    ccLicense = svg.element('cc:License', rdfRDF, attributes={"rdf:about":"http://creativecommons.org/licenses/by-sa/3.0/"})
+    svg.element('cc:permits', ccLicense, attributes={"rdf:resource":"http://creativecommons.org/ns#Reproduction"})
+    svg.element('cc:permits', ccLicense, attributes={"rdf:resource":"http://creativecommons.org/ns#Distribution"})
+    svg.element('cc:requires', ccLicense, attributes={"rdf:resource":"http://creativecommons.org/ns#Notice"})
+    svg.element('cc:requires', ccLicense, attributes={"rdf:resource":"http://creativecommons.org/ns#Attribution"})
+    svg.element('cc:permits', ccLicense, attributes={"rdf:resource":"http://creativecommons.org/ns#DerivativeWorks"})
+    svg.element('cc:requires', ccLicense, attributes={"rdf:resource":"http://creativecommons.org/ns#ShareAlike"})
+
+def buildStyle(svg, parent):
+    style = svg.element('style', parent, type='text/css')
+    svg.cdata(style, STYLE)
+
+def buildScript(svg, parent):
+    script = svg.element('script', parent, type='application/ecmascript')
+    svg.cdata(script, SCRIPT)
+
+def buildStyleLink(svg, parent, url):
+    style = svg.element('style', parent, type='text/css')
+    svg.cdata(style, '@import url(%s);'%url)
+
+def buildScriptLink(svg, parent, url):
+    svg.element('script', parent, {'xlink:href':url}, type='application/ecmascript')
+
+def getAssets():
+    """Return {'js': (file name, content), 'css': (file name, content)} of the
+    shared script and stylesheet. The file names contain a hash of the content,
+    so they can be cached forever."""
+    if not assetFiles:
+        import hashlib
+        for ext, data in (('js', SCRIPT), ('css', STYLE)):
+            assetFiles[ext] = ('pmdive-%s.%s'%(
+                hashlib.sha1(data).hexdigest()[:12], ext), data)
+    return assetFiles
+
+def writeAssets(directory=''):
+    """Write shared script and stylesheet to directory if missing."""
+    if directory in assetDirs:
+        return
+    for name, data in getAssets().values():
+        path = os.path.join(directory, name)
+        if not os.path.exists(path):
+            with atomicOutput(path) as f:
+                f.write(data)
+    assetDirs.add(directory)
+
+templateCache = {}
+assetFiles = {}
+assetDirs = set()
+
+def escape(data):
+    return data.replace("&", "&amp;").replace("<", "&lt;").replace(
+        '"', "&quot;").replace(">", "&gt;")
+
+def pathData(polylines):
+    """Return path data which draws all polylines (lists of (x, y) points)
+    with relative coordinates. A polyline ending at its first point is closed.
+    """
+    data = []
+    last = None
+    for polyline in polylines:
+        x, y = polyline[0]
+        if last is None:
+            data.append('M%s,%s'%(x, y))
+        else:
+            data.append('m%s,%s'%(x-last[0], y-last[1]))
+        last = polyline[0]
+        closed = len(polyline) > 2 and polyline[-1] == polyline[0]
+        for x1, y1 in closed and polyline[1:-1] or polyline[1:]:
+            if y1 == y:
+                data.append('h%s'%(x1-x))
+            elif x1 == x:
+                data.append('v%s'%(y1-y))
+            else:
+                data.append('l%s,%s'%(x1-x, y1-y))
+            x, y = x1, y1
+        if closed:
+            data.append('z')
+        else:
+            last = x, y
+    return ''.join(data)
+
+class SVGWriter(object):
+    """Streaming alternative to SVG. Elements are written to the stream as soon
+    as they are created, so elements must be created in document order. The
+    pretty output is byte-identical to SVG.doc.toprettyxml(), the compact
+    output is identical to SVG.doc.toxml()."""
+
+    def __init__(self, stream, page_width=297, page_height=420, pretty=True):
+        self.write = stream.write
+        self.indent, self.newl = pretty and ('\t', '\n') or ('', '')
+        self.stack = []
+        self.write('<?xml version="1.0" ?>%s<!DOCTYPE svg%s  PUBLIC '
+            "'-//W3C//DTD SVG 1.1//EN'%s  "
+            "'http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd'>%s"%(
+            self.newl, self.newl, self.newl, self.newl))
+        self.root = self.element('svg', None, {
+            'version':'1.1',
+            'width':'%smm'%page_width,
+            'height':'%smm'%page_height,
+            'viewBox':'0 0 %s00 %s00'%(page_width, page_height),
+            'preserveAspectRatio':'xMinYMin slice',
+            'xmlns':'http://www.w3.org/2000/svg',
+            'xmlns:xlink':'http://www.w3.org/1999/xlink'})
+
+    def _open(self, parent):
+        while self.stack and self.stack[-1] is not parent:
+            self._end()
+        if parent is not None:
+            if not self.stack:
+                raise ValueError("Parent element is already written")
+            if parent[1] is False:
+                self.write('>' + self.newl)
+                parent[1] = True
+
+    def _end(self):
+        ename, children = self.stack.pop()
+        if children:
+            self.write('%s</%s>%s'%(self.indent*len(self.stack), ename, self.newl))
+        else:
+            self.write('/>' + self.newl)
+
+    def _start(self, ename, parent, attributes, kwargs):
+        self._open(parent)
+        attrs = dict(attributes)
+        for (key, value) in kwargs.iteritems():
+            if key not in ('attributes', 'parent'):
+                attrs[key] = value
+        self.write(self.indent*len(self.stack) + '<' + ename + ''.join(
+            [' %s="%s"'%(key, escape(attrs[key])) for key in sorted(attrs)]))
+
+    def element(self, ename, parent=None, attributes={}, **kwargs):
+        self._start(ename, parent, attributes, kwargs)
+        el = [ename, False]
+        self.stack.append(el)
+        return el
+
+    def textNode(self, ename, data, parent=None, **kwargs):
+        self._start(ename, parent, {}, kwargs)
+        self.write('>%s</%s>%s'%(escape(data), ename, self.newl))
+
+    def cdata(self, node, data):
+        self._open(node)
+        self.write('<![CDATA[%s]]>'%data)
+
+    def fragment(self, parent, build):
+        """Write static fragment built by build(svg, parent). The fragment is
+        built only once per process, later it is copied from templateCache."""
+        self._open(parent)
+        key = (build, len(self.stack), self.newl)
+        text = templateCache.get(key)
+        if text is None:
+            write, chunks = self.write, []
+            self.write = chunks.append
+            try:
+                build(self, parent)
+                self._open(parent)
+            finally:
+                self.write = write
+            text = templateCache.setdefault(key, ''.join(chunks))
+        self.write(text)
+
+    def close(self):
+        while self.stack:
+            self._end()
+
+
+class Extents(object):
+    """Backend for pmDive.getSymbols which does not build any document, but
+    only collects the bounding boxes [x0, y0, x1, y1] of the symbols."""
+
+    def __init__(self):
+        self.boxes = []
+
+    def element(self, ename, parent=None, attributes={}, **kwargs):
+        if ename == 'symbol':
+            box = [float('inf'), float('inf'), float('-inf'), float('-inf')]
+            self.boxes.append(box)
+            return box
+        attrs = dict(attributes)
+        attrs.update(kwargs)
+        if ename == 'polyline':
+            coords = [p.split(',') for p in attrs['points'].split()]
+        elif ename == 'circle':
+            cx, cy, r = int(attrs['cx']), int(attrs['cy']), int(attrs['r'])
+            coords = [(cx-r, cy-r), (cx+r, cy+r)]
+        elif ename == 'rect':
+            x, y = int(attrs['x']), int(attrs['y'])
+            coords = [(x, y), (x+int(attrs['width']), y+int(attrs['height']))]
+        elif ename == 'line':
+            coords = [(attrs['x1'], attrs['y1']), (attrs['x2'], attrs['y2'])]
+        else:
+            coords = []
+        for x, y in coords:
+            x, y = int(x), int(y)
+            parent[0] = min(parent[0], x)
+            parent[1] = min(parent[1], y)
+            parent[2] = max(parent[2], x)
+            parent[3] = max(parent[3], y)
+        return parent
+
+
+# outline layers in plotting order with DXF color and HPGL pen number
+LAYERS = (('cut', 1, 1), ('fold', 5, 2), ('circles', 3, 3))
+
+class DXFWriter(object):
+    """Plotter backend which streams outlines as AutoCAD R12 DXF file with
+    one layer per outline type. Coordinates are in mm with 1/100 mm
+    resolution and y axis pointing up."""
+
+    def __init__(self, stream, page_width=297, page_height=420):
+        self.stream = stream
+        self.height = int(round(page_height*100))
+        self.group(0, 'SECTION', 2, 'HEADER', 9, '$ACADVER', 1, 'AC1009',
+            9, '$INSUNITS', 70, 4, 0, 'ENDSEC')
+        self.group(0, 'SECTION', 2, 'TABLES', 0, 'TABLE', 2, 'LAYER',
+            70, len(LAYERS))
+        for layer, color, pen in LAYERS:
+            self.group(0, 'LAYER', 2, layer.upper(), 70, 0, 62, color,
+                6, 'CONTINUOUS')
+        self.group(0, 'ENDTAB', 0, 'ENDSEC', 0, 'SECTION', 2, 'ENTITIES')
+
+    def group(self, *pairs):
+        self.stream.write(''.join(['%3d\n%s\n'%(pairs[i], pairs[i+1])
+            for i in xrange(0, len(pairs), 2)]))
+
+    def point(self, x, y, index=0):
+        return (10+index, '%.2f'%(x/100.0), 20+index,
+            '%.2f'%((self.height-y)/100.0), 30+index, '0.0')
+
+    def polyline(self, layer, points):
+        layer = layer.upper()
+        if len(points) == 2:
+            self.group(*(0, 'LINE', 8, layer) + self.point(*points[0]) +
+                self.point(*points[1], index=1))
+            return
+        self.group(0, 'POLYLINE', 8, layer, 66, 1, 10, '0.0', 20, '0.0',
+            30, '0.0', 70, 0)
+        for x, y in points:
+            self.group(*(0, 'VERTEX', 8, layer) + self.point(x, y))
+        self.group(0, 'SEQEND', 8, layer)
+
+    def circle(self, layer, cx, cy, r):
+        self.group(*(0, 'CIRCLE', 8, layer.upper()) + self.point(cx, cy) +
+            (40, '%.2f'%(r/100.0)))
+
+    def close(self):
+        self.group(0, 'ENDSEC', 0, 'EOF')
+
+
+class HPGLWriter(object):
+    """Plotter backend which streams outlines as HP-GL with one pen per
+    outline type. User units are scaled to 1/100 mm."""
+
+    def __init__(self, stream, page_width=297, page_height=420):
+        self.stream = stream
+        self.height = int(round(page_height*100))
+        self.pens = dict([(layer, pen) for layer, color, pen in LAYERS])
+        self.pen = None
+        # 4000 plotter units of 0.025 mm are 10000 user units of 0.01 mm
+        self.stream.write('IN;IP0,0,4000,4000;SC0,10000,0,10000;')
+
+    def select(self, layer):
+        if self.pens[layer] != self.pen:
+            self.pen = self.pens[layer]
+            self.stream.write('SP%s;'%self.pen)
+
+    def polyline(self, layer, points):
+        self.select(layer)
+        points = ['%s,%s'%(x, self.height-y) for x, y in points]
+        self.stream.write('PU%s;PD%s;\n'%(points[0], ','.join(points[1:])))
+
+    def circle(self, layer, cx, cy, r):
+        self.select(layer)
+        self.stream.write('PU%s,%s;CI%s;\n'%(cx, self.height-cy, r))
+
+    def close(self):
+        self.stream.write('PU;SP0;\n')
+
+# plotter backends by output file extension
+PLOTTERS = {'.dxf':DXFWriter, '.hpgl':HPGLWriter, '.plt':HPGLWriter}
+
+
+class SegmentGrid(object):
+    """Uniform grid spatial index of items with bounding boxes."""
+
+    def __init__(self, size=4000):
+        self.size = size
+        self.cells = {}
+        self.items = []
+
+    def add(self, item, x0, y0, x1, y1):
+        """Add item with bounding box x0, y0, x1, y1."""
+        size = self.size
+        index = len(self.items)
+        self.items.append((item, x0, y0, x1, y1))
+        for x in xrange(int(x0//size), int(x1//size) + 1):
+            for y in xrange(int(y0//size), int(y1//size) + 1):
+                self.cells.setdefault((x, y), []).append(index)
+
+    def addPolyline(self, item, points):
+        """Add every segment of polyline points (integer coordinates) as item
+        + ((p, q), index)."""
+        size = self.size
+        items = self.items
+        setdefault = self.cells.setdefault
+        number = len(items)
+        for index in xrange(len(points) - 1):
+            p, q = points[index], points[index + 1]
+            x0, x1 = (p[0], q[0]) if p[0] < q[0] else (q[0], p[0])
+            y0, y1 = (p[1], q[1]) if p[1] < q[1] else (q[1], p[1])
+            items.append((item + ((p, q), index), x0, y0, x1, y1))
+            cx0, cy0, cx1, cy1 = x0//size, y0//size, x1//size, y1//size
+            if cx0 == cx1 and cy0 == cy1:
+                setdefault((cx0, cy0), []).append(number)
+            else:
+                for x in xrange(cx0, cx1 + 1):
+                    for y in xrange(cy0, cy1 + 1):
+                        setdefault((x, y), []).append(number)
+            number += 1
+
+    def pairs(self):
+        """Yield every pair of items with overlapping bounding boxes once. A
+        pair is yielded only from the cell of the lower corner of the
+        overlap."""
+        items = self.items
+        size = self.size
+        for (x, y), cell in self.cells.iteritems():
+            x, y = x*size, y*size
+            for i, a in enumerate(cell):
+                a, ax0, ay0, ax1, ay1 = items[a]
+                for b in cell[i+1:]:
+                    b, bx0, by0, bx1, by1 = items[b]
+                    if bx0 > ax1 or ax0 > bx1 or by0 > ay1 or ay0 > by1:
+                        continue
+                    if (0 <= (ax0 if ax0 > bx0 else bx0) - x < size and
+                            0 <= (ay0 if ay0 > by0 else by0) - y < size):
+                        yield a, b
+
+def orientation(p, q, r):
+    v = (q[0]-p[0])*(r[1]-p[1]) - (q[1]-p[1])*(r[0]-p[0])
+    return (v > 0) - (v < 0)
+
+def segmentsCross(p1, p2, q1, q2):
+    """Return the crossing point of two segments or None if they do not cross
+    in inner points (touching and collinear segments do not cross)."""
+    if (orientation(p1, p2, q1) * orientation(p1, p2, q2) >= 0 or
+            orientation(q1, q2, p1) * orientation(q1, q2, p2) >= 0):
+        return None
+    dx, dy = p2[0]-p1[0], p2[1]-p1[1]
+    ex, ey = q2[0]-q1[0], q2[1]-q1[1]
+    t = float((q1[0]-p1[0])*ey - (q1[1]-p1[1])*ex) / (dx*ey - dy*ex)
+    return p1[0]+t*dx, p1[1]+t*dy
+
+def segmentDistance(c, p, q):
+    """Return distance of point c to segment p, q."""
+    dx, dy = q[0]-p[0], q[1]-p[1]
+    t = 0.0
+    if dx or dy:
+        t = max(0.0, min(1.0, ((c[0]-p[0])*dx + (c[1]-p[1])*dy) /
+            float(dx*dx + dy*dy)))
+    return math.hypot(p[0]+t*dx-c[0], p[1]+t*dy-c[1])
+
+
+def penTravel(items, position):
+    """Return pen up travel from position along outline items (layer, data)
+    and the final pen position."""
+    travel = 0
+    for layer, data in items:
+        if layer == 'circles':
+            start = end = data[:2]
+        else:
+            start, end = data[0], data[-1]
+        travel += math.hypot(start[0]-position[0], start[1]-position[1])
+        position = end
+    return travel, position
+
+def orderStrokes(items, position):
+    """Return outline items (layer, data) of one tool reordered to reduce the
+    pen up travel from position: nearest neighbour order improved by 2-opt.
+    Open polylines may be reversed, closed polylines may start at any of
+    their points."""
+    distance = lambda p, q: math.hypot(p[0]-q[0], p[1]-q[1])
+    def ends(item):
+        layer, data = item
+        if layer == 'circles':
+            return data[:2], data[:2]
+        return data[0], data[-1]
+    rest = list(items)
+    order = []
+    start = position
+    while rest:
+        best = None
+        for index, (layer, data) in enumerate(rest):
+            if layer == 'circles':
+                candidates = [data]
+            elif data[0] == data[-1]:
+                k = min(xrange(len(data) - 1),
+                    key=lambda k: distance(start, data[k]))
+                candidates = [data[k:-1] + data[:k+1]]
+            else:
+                candidates = [data, data[::-1]]
+            for data in candidates:
+                d = distance(start, ends((layer, data))[0])
+                if best is None or d < best[0]:
+                    best = (d, index, (layer, data))
+        order.append(best[2])
+        del rest[best[1]]
+        start = ends(best[2])[1]
+    # reversing order[i:j+1] reverses every stroke of it too, only the
+    # travel to order[i] and from order[j] changes
+    points = [ends(item) for item in order]
+    improved = True
+    while improved:
+        improved = False
+        for i in xrange(len(order)):
+            before = i and points[i-1][1] or position
+            for j in xrange(i, len(order)):
+                delta = (distance(before, points[j][1]) -
+                    distance(before, points[i][0]))
+                if j + 1 < len(order):
+                    after = points[j+1][0]
+                    delta += (distance(points[i][0], after) -
+                        distance(points[j][1], after))
+                if delta < -1:
+                    order[i:j+1] = [(layer, layer == 'circles' and data or
+                        data[::-1]) for layer, data in order[i:j+1][::-1]]
+                    points[i:j+1] = [ends(item) for item in order[i:j+1]]
+                    improved = True
+    return order
+
+
+class PatternGeometry(object):
+    """Points of one side of the pattern stored as flat array of int
+    coordinates (x0, y0, x1, y1, ...). Points are returned as (x, y) tuples by
+    index or by anchor name. coords supports the buffer protocol and can be
+    passed to numpy or writers without copying."""
+
+    __slots__ = ('coords',)
+
+    # indices of the points used for the symbols, pages and image
+    ANCHORS = {'top':1, 'fold':3, 'lens':6, 'tab':8, 'tabEnd':11,
+        'bottom':19, 'depth':22, 'back':23, 'strap':24, 'strapEnd':25,
+        'end':26}
+
+    def __init__(self, coords):
+        self.coords = array.array('i', coords)
+
+    def __len__(self):
+        return len(self.coords)/2
+
+    def __getitem__(self, index):
+        coords = self.coords
+        if isinstance(index, slice):
+            return [(coords[i*2], coords[i*2+1])
+                for i in xrange(*index.indices(len(coords)/2))]
+        if index < 0:
+            index += len(coords)/2
+        return coords[index*2], coords[index*2+1]
+
+    def __getattr__(self, name):
+        try:
+            return self[self.ANCHORS[name]]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __iter__(self):
+        coords = self.coords
+        for i in xrange(0, len(coords), 2):
+            yield coords[i], coords[i+1]
+
+    def __reduce__(self):
+        return PatternGeometry, (self.coords,)
+
+    def __repr__(self):
+        return 'PatternGeometry(%r)'%list(self)
+
+    def asarray(self):
+        """Return (N, 2) numpy array sharing the memory of coords."""
+        import numpy
+        return numpy.frombuffer(self.coords, numpy.intc).reshape(-1, 2)
+
+
+class LRUCache(object):
+    """Thread-safe bounded mapping which evicts the least recently used
+    entries and counts cache hits and misses."""
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.clear()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data = OrderedDict()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        return {'hits':self.hits, 'misses':self.misses,
+                'size':len(self.data), 'maxsize':self.maxsize}
+
+geometryCache = LRUCache(256)
+responseCache = LRUCache(256)
+
+# MIME types of logo files by extension
+LOGO_TYPES = {'.png':'image/png', '.jpg':'image/jpeg', '.jpeg':'image/jpeg',
+    '.svg':'image/svg+xml'}
+
+def downsampleImage(data, size):
+    """Return PNG or JPEG image data scaled down to at most size pixels width
+    and height. Requires PIL."""
+    from PIL import Image
+    import StringIO
+    image = Image.open(StringIO.StringIO(data))
+    if max(image.size) <= size:
+        return data
+    format = image.format
+    image.thumbnail((size, size), Image.ANTIALIAS)
+    f = StringIO.StringIO()
+    image.save(f, format)
+    return f.getvalue()
+
+class LogoCache(object):
+    """Logo files encoded as data URIs. The URIs are cached in memory by path,
+    mtime and size of the file and in directory (if not None) by hash of the
+    file content, so every logo is encoded once per batch or server process.
+    """
+
+    def __init__(self, directory=None, maxsize=64):
+        self.directory = directory
+        self.memory = LRUCache(maxsize)
+
+    def get(self, logo, size=None):
+        """Return data URI of logo file, downsampled to at most size pixels.
+        Values which are not names of existing files are returned unchanged.
+        """
+        try:
+            st = os.stat(logo)
+        except (OSError, TypeError, ValueError):
+            return logo
+        key = (os.path.abspath(logo), st.st_mtime, st.st_size, size)
+        uri = self.memory.get(key)
+        if uri is None:
+            uri = self.encode(logo, size)
+            self.memory.set(key, uri)
+        return uri
+
+    def encode(self, logo, size=None):
+        import base64, hashlib
+        mime = LOGO_TYPES.get(os.path.splitext(logo)[1].lower())
+        if mime is None:
+            raise ValueError("Unsupported logo file type: %s"%logo)
+        f = open(logo, 'rb')
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        path = None
+        if self.directory is not None:
+            path = os.path.join(self.directory, '%s-%s.uri'%(
+                hashlib.sha1(data).hexdigest(), size and int(size) or 0))
+            if os.path.isfile(path):
+                f = open(path, 'rb')
+                try:
+                    return f.read()
+                finally:
+                    f.close()
+        if size and mime != 'image/svg+xml':
+            data = downsampleImage(data, int(size))
+        uri = 'data:%s;base64,%s'%(mime, base64.b64encode(data))
+        if path is not None:
+            import tempfile
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            fd, tmp = tempfile.mkstemp('.tmp', '', self.directory)
+            f = os.fdopen(fd, 'wb')
+            try:
+                f.write(uri)
+            finally:
+                f.close()
+            os.chmod(tmp, 0644)
+            os.rename(tmp, path)
+        return uri
+
+logoCache = LogoCache()
+
+def normalizeName(name):
+    """Return lower case device name with words of letters and digits
+    separated by single spaces."""
+    import re
+    return ' '.join(re.findall('[a-z0-9]+', name.lower()))
+
+def wordTrigrams(word):
+    """Return set of three character substrings of word padded with
+    spaces."""
+    word = ' %s '%word
+    return set([word[i:i+3] for i in xrange(len(word) - 2)])
+
+class DeviceDatabase(object):
+    """Device models (name and aliases) with their dimensions. The CSV source
+    file (name, aliases separated by |, height, width, depth, screen middle in
+    mm) is indexed in a SQLite file next to it (or in memory, if the directory
+    is not writable) on the first lookup. The index is rebuilt when the source
+    file or the index version changes."""
+
+    version = 1
+
+    def __init__(self, filename, index=None):
+        self.filename = filename
+        self.index = index or os.path.splitext(filename)[0] + '.db'
+        self.db = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        import sqlite3
+        if self.db is not None:
+            return self.db
+        try:
+            fresh = (os.path.getmtime(self.index) >=
+                os.path.getmtime(self.filename))
+        except OSError:
+            fresh = False
+        if fresh:
+            try:
+                db = sqlite3.connect(self.index)
+                try:
+                    fresh = db.execute('PRAGMA user_version'
+                        ).fetchone()[0] == self.version
+                finally:
+                    db.close()
+            except sqlite3.Error:
+                fresh = False
+        if not fresh:
+            try:
+                self.build(self.index)
+            except (EnvironmentError, sqlite3.Error):
+                self.index = ':memory:'
+        self.db = sqlite3.connect(self.index, check_same_thread=False)
+        if self.index == ':memory:':
+            self.build(self.db)
+        return self.db
+
+    def build(self, index):
+        """Build index from source file, index is file name or connection."""
+        import csv, sqlite3
+        if isinstance(index, basestring):
+            import tempfile
+            fd, tmp = tempfile.mkstemp('.tmp', '', os.path.dirname(index))
+            os.close(fd)
+            try:
+                db = sqlite3.connect(tmp)
+                self.build(db)
+                db.close()
+                os.chmod(tmp, 0644)
+                os.rename(tmp, index)
+            except:
+                os.remove(tmp)
+                raise
+            return
+        index.executescript("""
+            CREATE TABLE devices (id INTEGER PRIMARY KEY, name TEXT,
+                height REAL, width REAL, depth REAL, screen_middle REAL);
+            CREATE TABLE names (key TEXT, device INTEGER);
+            CREATE TABLE tokens (token TEXT, device INTEGER);
+            CREATE TABLE vocabulary (token TEXT PRIMARY KEY, count INTEGER);
+            CREATE TABLE trigrams (trigram TEXT, length INTEGER, token TEXT);""")
+        f = open(self.filename, 'rb')
+        try:
+            reader = csv.reader(f)
+            reader.next()
+            for row in reader:
+                if not row or row[0].startswith('#'):
+                    continue
+                name, aliases, height, width, depth, middle = [
+                    v.strip() for v in row]
+                device = index.execute('INSERT INTO devices VALUES '
+                    '(NULL, ?, ?, ?, ?, ?)', (name.decode('utf-8'),
+                    float(height), float(width), float(depth),
+                    middle and float(middle) or None)).lastrowid
+                keys = set([normalizeName(n) for n in
+                    [name] + aliases.split('|') if n.strip()])
+                index.executemany('INSERT INTO names VALUES (?, ?)',
+                    [(key, device) for key in keys])
+                index.executemany('INSERT INTO tokens VALUES (?, ?)',
+                    [(token, device) for token in
+                    set(' '.join(keys).split())])
+        finally:
+            f.close()
+        index.executescript("""
+            CREATE INDEX names_key ON names (key);
+            CREATE INDEX tokens_token ON tokens (token, device);
+            CREATE INDEX tokens_device ON tokens (device, token);
+            INSERT INTO vocabulary
+                SELECT token, count(*) FROM tokens GROUP BY token;""")
+        words = [r[0] for r in index.execute('SELECT token FROM vocabulary')]
+        index.executemany('INSERT INTO trigrams VALUES (?, ?, ?)',
+            [(trigram, len(word), word) for word in words
+            for trigram in wordTrigrams(word)])
+        index.execute('CREATE INDEX trigrams_trigram ON trigrams '
+            '(trigram, length, token)')
+        index.execute('PRAGMA user_version = %d'%self.version)
+        index.commit()
+
+    def search(self, model, limit=10):
+        """Return up to limit (name, height, width, depth, screen_middle)
+        rows matching model: exact name or alias first, then names starting
+        with model and names with words starting with all words of model. If
+        nothing matches, misspelled words are replaced by similar ones."""
+        key = normalizeName(model)
+        if not key:
+            return []
+        with self.lock:
+            db = self.connect()
+            ids = [r[0] for r in db.execute('SELECT device FROM names '
+                'WHERE key = ?', (key,))]
+            ids += [r[0] for r in db.execute('SELECT device FROM names '
+                'WHERE key > ? AND key < ? ORDER BY key LIMIT ?',
+                (key, key + '~', limit))]
+            tokens = key.split()
+            if len(set(ids)) < limit:
+                ids += self.matchTokens(db, tokens, limit)
+            if not ids:
+                tokens = [self.correctToken(db, token) for token in tokens]
+                if None not in tokens:
+                    ids = self.matchTokens(db, tokens, limit)
+            rows = []
+            for device in ids:
+                row = db.execute('SELECT name, height, width, depth, '
+                    'screen_middle FROM devices WHERE id = ?',
+                    (device,)).fetchone()
+                if row not in rows:
+                    rows.append(row)
+                if len(rows) == limit:
+                    break
+        return rows
+
+    def matchTokens(self, db, tokens, limit):
+        """Return up to limit ids of devices with words starting with all
+        tokens. Candidates are taken from the least frequent token."""
+        tokens = sorted([(db.execute('SELECT total(count) FROM vocabulary '
+            'WHERE token >= ? AND token < ?', (token, token + '~')
+            ).fetchone()[0], token) for token in tokens])
+        ids = []
+        for (device,) in db.execute('SELECT device FROM tokens '
+                'WHERE token >= ? AND token < ?',
+                (tokens[0][1], tokens[0][1] + '~')):
+            if device in ids:
+                continue
+            for count, token in tokens[1:]:
+                if db.execute('SELECT 1 FROM tokens WHERE device = ? AND '
+                        'token >= ? AND token < ?', (device, token,
+                        token + '~')).fetchone() is None:
+                    break
+            else:
+                ids.append(device)
+                if len(ids) == limit:
+                    break
+        return ids
+
+    def correctToken(self, db, token):
+        """Return token or the most similar known word, None if there is
+        no similar word. Only the words with the same first letter sharing
+        most trigrams with token are compared."""
+        if db.execute('SELECT 1 FROM vocabulary WHERE token >= ? AND '
+                'token < ?', (token, token + '~')).fetchone() is not None:
+            return token
+        import difflib
+        trigrams = list(wordTrigrams(token))
+        words = [r[0] for r in db.execute('SELECT token FROM trigrams '
+            'WHERE trigram IN (%s) AND length BETWEEN ? AND ? AND token >= ? '
+            'AND token < ? GROUP BY token ORDER BY count(*) DESC, token '
+            'LIMIT 20'%', '.join('?'*len(trigrams)), trigrams + [len(token) - 2,
+            len(token) + 2, token[0], token[0] + '~'])]
+        words = difflib.get_close_matches(token, words, 1, 0.7)
+        return words and words[0] or None
+
+    def lookup(self, model):
+        """Return (height, width, depth, screen_middle) of device model
+        (name, alias or unique part of it). Raises AttributeError with
+        suggestions, if the model is unknown or ambiguous."""
+        with self.lock:
+            row = self.connect().execute('SELECT height, width, depth, '
+                'screen_middle FROM devices JOIN names ON id = device '
+                'WHERE key = ?', (normalizeName(model),)).fetchone()
+        if row is not None:
+            return row
+        rows = self.search(model)
+        if len(rows) == 1:
+            return rows[0][1:]
+        if not rows:
+            raise AttributeError("Unknown device: %s"%model)
+        raise AttributeError("Ambiguous device %s: %s"%(model,
+            ', '.join([r[0] for r in rows])))
+
+devices = DeviceDatabase(os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'devices.csv'))
+
+@contextmanager
+def nullStage(name):
+    yield
+
+
+class Stats(object):
+    """Collects wall time and net number of gc tracked objects (containers
+    like lists, dicts and instances, no strings or numbers) created per stage
+    of pattern generation. Optional callback(name, seconds, objects) is
+    called after every stage. Counting walks all gc tracked objects and the
+    garbage collector is disabled during the stages, so that collections do
+    not hide the created objects. It can be turned off by objects=False."""
+
+    def __init__(self, callback=None, objects=True):
+        self.callback = callback
+        self.counting = objects
+        self.times = OrderedDict()
+        self.objects = OrderedDict()
+
+    def count(self):
+        return self.counting and len(gc.get_objects()) or 0
+
+    @contextmanager
+    def stage(self, name):
+        enabled = gc.isenabled()
+        if self.counting:
+            gc.disable()
+        objects = self.count()
+        start = timeit.default_timer()
+        try:
+            yield
+        finally:
+            seconds = timeit.default_timer() - start
+            objects = self.count() - objects
+            if enabled:
+                gc.enable()
+            self.times[name] = self.times.get(name, 0) + seconds
+            self.objects[name] = self.objects.get(name, 0) + objects
+            if self.callback is not None:
+                self.callback(name, seconds, objects)
+
+    def report(self):
+        total = sum(self.times.values()) or 1
+        lines = ['%-12s %10s %7s %10s'%('stage', 'ms', '%', 'gc objects')]
+        for name, seconds in self.times.iteritems():
+            lines.append('%-12s %10.3f %7.1f %10d'%(name, seconds*1000,
+                seconds*100/total, self.objects[name]))
+        return '\n'.join(lines)
+
+SCHEMA = (
+    # name, type, minimum, maximum (both exclusive), None allowed, aliases
+    ('page_width', float, 99, 499, False, ()),
+    ('page_height', float, 99, 499, False, ()),
+    ('device_width', float, 49, 101, False, ()),
+    ('device_height', float, 89, 201, False, ()),
+    ('device_depth', float, 4, 21, False, ()),
+    ('device_screen_middle', float, 29, 201, True, ()),
+    ('lens_focal_length', float, 29, 51, False, ()),
+    ('lens_diameter', float, 19, 31, False, ()),
+    ('strap_width', float, 19, 47, False, ()),
+    ('pupillary_distance', float, 49, 81, False, ('pd',)),
+    ('page', float, 0, 3, True, ()),
+    ('noscript', float, 0, 3, True, ()),
+    ('logo', str, None, None, False, ()),
+    ('logo_size', float, 15, 4097, True, ()),
+    )
+
+PARAMS = tuple([field[0] for field in SCHEMA])
+
+# pmDive.updateSVG actions required after change of an attribute
+UPDATES = {
+    'page_width':('updateViewBox', 'updatePages'),
+    'page_height':('updateViewBox',),
+    'device_width':('updateSymbols',),
+    'device_height':('updateSymbols',),
+    'device_depth':('updateSymbols',),
+    'device_screen_middle':('updateSymbols',),
+    'lens_focal_length':('updateSymbols',),
+    'lens_diameter':('updateCircles',),
+    'strap_width':('updateStrapWidth',),
+    'pupillary_distance':('updateCircles',),
+    'page':('updatePages',),
+    'noscript':('updateScript',),
+    'logo':('updateImage',),
+    'logo_size':('updateImage',),
+    }
+UPDATE_ORDER = ('updateViewBox', 'updateSymbols', 'updateCircles',
+    'updateStrapWidth', 'updatePages', 'updateImage', 'updateScript')
+
+def compileField(ftype, minimum, maximum, nullable):
+    """Return validator function for one SCHEMA field, which returns the
+    converted value or raises AttributeError."""
+    if ftype is str:
+        convert = lambda value: isinstance(value, basestring) and value or str(value)
+    else:
+        convert = ftype
+    def validate(value):
+        if value is None or str(value) == 'None':
+            if nullable:
+                return None
+            raise AttributeError("Property value out of range")
+        value = convert(value)
+        if minimum is not None and not minimum < value < maximum:
+            raise AttributeError("Property value out of range")
+        return value
+    return validate
+
+def compileSchema(schema):
+    """Return {name or alias: (name, validator)} for all SCHEMA fields."""
+    validators = {}
+    for name, ftype, minimum, maximum, nullable, aliases in schema:
+        validator = compileField(ftype, minimum, maximum, nullable)
+        for key in (name,) + aliases:
+            validators[key] = (name, validator)
+    return validators
+
+VALIDATORS = compileSchema(SCHEMA)
+
+def validateParam(name, value):
+    """Validate attribute value and return list of (name, value) pairs which
+    must be assigned to pmDive instance. Setting device_height (or dimensions
+    in form HxWxD) resets device_screen_middle, device (model name) sets all
+    device dimensions from the devices database."""
+    if name == 'device':
+        height, width, depth, middle = devices.lookup(str(value))
+        return [('device_width', VALIDATORS['device_width'][1](width)),
+                ('device_depth', VALIDATORS['device_depth'][1](depth)),
+                ('device_screen_middle', None),
+                ('device_height', VALIDATORS['device_height'][1](height)),
+                ('device_screen_middle',
+                    VALIDATORS['device_screen_middle'][1](middle))]
+    if name == 'dimensions':
+        values = str(value).lower().split('x')
+        if len(values) != 3:
+            raise AttributeError("Property value out of range")
+        return [('device_width', VALIDATORS['device_width'][1](values[1])),
+                ('device_depth', VALIDATORS['device_depth'][1](values[2])),
+                ('device_screen_middle', None),
+                ('device_height', VALIDATORS['device_height'][1](values[0]))]
+    try:
+        name, validator = VALIDATORS[name]
+    except KeyError:
+        raise AttributeError("Incorrect property name: %s"%name)
+    if name == 'device_height':
+        return [('device_screen_middle', None), (name, validator(value))]
+    return [(name, validator(value))]
+
+def validateRecords(records):
+    """Validate batch of records (dicts or lists of (name, value) pairs).
+
+    Returns (params, errors), where params contains for every record the list
+    of validated (name, value) pairs or None if the record is invalid, and
+    errors is the list of (record index, name, error message) of all invalid
+    fields."""
+    params = []
+    errors = []
+    for index, record in enumerate(records):
+        if isinstance(record, dict):
+            record = record.iteritems()
+        values = []
+        valid = True
+        for name, value in record:
+            try:
+                values.extend(validateParam(name, value))
+            except (AttributeError, ValueError) as e:
+                errors.append((index, name, str(e)))
+                valid = False
+        params.append(valid and values or None)
+    return params, errors
+
+
+class PatternBuilder(object):
+    """Methods for building the pattern from the attributes of pmDive, shared
+    by pmDive and Params."""
+
+    __slots__ = ()
+
+    def getParams(self):
+        """Return normalized (name, value) pairs of all attributes which
+        affect the output. The result can be used as cache key."""
+        return tuple([(name, name == 'noscript' and bool(self.noscript) or
+            getattr(self, name)) for name in PARAMS])
+
+    def getSVGParams(self):
+        """Return (name, value) pairs for the param elements."""
+        return [('page_width', str(self.page_width)),
+                ('page_height', str(self.page_height)),
+                ('device_width', str(self.device_width)),
+                ('device_height', str(self.device_height)),
+                ('device_depth', str(self.device_depth)),
+                ('device_screen_middle', str(self.device_screen_middle or "")),
+                ('lens_focal_length', str(self.lens_focal_length)),
+                ('lens_diameter', str(self.lens_diameter)),
+                ('pupillary_distance', str(self.pupillary_distance)),
+                ('strap_width', str(self.strap_width)),
+                ('page', str(self.page or ""))]
+
+    def getScreenMiddle(self, side='Right'):
+        if self.device_screen_middle is None:
+            return self.device_height/2
+        if side=='Right':
+            return self.device_height-self.device_screen_middle
+        else:
+            return self.device_screen_middle
+
+    def getPoints(self, side='Right'):
+        """Return PatternGeometry of side. The instance is shared through
+        geometryCache and must not be modified."""
+        key = (self.device_width, self.device_depth, self.lens_focal_length,
+            self.getScreenMiddle(side))
+        points = geometryCache.get(key)
+        if points is None:
+            points = self.calcPoints(side)
+            geometryCache.set(key, points)
+        return points
+
+    def calcPoints(self, side='Right'):
+        middle = self.getScreenMiddle(side)
+        width = int(round((self.device_width/2-25)*100))
+        focal = int(round(((middle-58)**2+self.lens_focal_length**2)**.5*100))
+        depth = int(round(self.device_depth*100+100))
+        x = int(middle*100+100)
+        y = int(round(((self.device_width/2-25)**2+self.lens_focal_length**2)**.5*100)) + 9000
+        lx, ly = focal+5800, width+9000
+        angle = math.atan((ly-9000)/(lx-5800.0))+math.atan(1)
+        angle1 = math.atan((y-9000)/(x-5800.0))
+        if abs(angle1) > angle:
+            angle1 = angle
+        cx, cy = int(round(5800+abs(math.cos(angle1)*1414))), int(round(abs(math.sin(angle1)*1414))) + 9000
+        ex, ey = lx-int(round(abs(math.sin(angle-math.atan(1))*1000))), ly+int(round(abs(math.cos(angle-math.atan(1))*1000)))
+        ty = ly - int(self.device_width*100) - 1000
+        coords = [0, y-1200, 1300, y, x, y, 5800, 9000, cx, cy, ex, ey, lx, ly,
+            lx, ly+1000, lx+1000, ly+1000, lx+1000, ty, lx, ty, lx, ty+1000,
+            ex, 13000-ey]
+        if angle > math.asin(1):
+            coords.extend((5800, 3300))
+        else:
+            coords.extend((cx, 13000-cy))
+        coords.extend((5800, 4000, 5600, 4000, 5600, 0, 5600, 4000, 5800, 4000))
+        y = int(round(((self.device_width/2-25)**2+(self.lens_focal_length-1)**2)**.5*100)) + 4000
+        end = y+depth+int(round(self.device_width*100+100))
+        coords.extend((x, y, x+depth, y, x+depth, y+depth, x, y+depth,
+            x+depth, y+depth, x+depth+focal, y+depth+width,
+            x+depth+focal, y+depth+width+5000, x+depth, end, 1300, end,
+            0, end-1200))
+        return PatternGeometry(coords)
+
+    def getCircles(self):
+        """Return attributes of the circles in up and down symbols."""
+        cx_int = int(round(self.pupillary_distance*50))
+        r_int = int(round(self.lens_diameter*50))
+        return ([{'cx':str(cx_int), 'cy':'6500', 'r':str(r_int-200)},
+                 {'cx':str(cx_int), 'cy':'1500', 'r':str(r_int)}],
+                [{'cx':str(cx_int), 'cy':'1500', 'r':str(r_int-200)}])
+
+    def getRects(self, points):
+        """Return attributes of the strap rects in up and down symbols."""
+        strap_width=int(self.strap_width*100+200)
+        y_int=int(round(6500 - strap_width/2))
+        urects = [{'x':x, 'y':str(y_int), 'width':'200', 'height':str(strap_width)} for x in ('5600', '6800', '7800')]
+        (x_int, y0), (_, y1) = points.strap, points.strapEnd
+        y_int=int(round(((y1-y0)-strap_width)/2)+y0)
+        rects = [{'x':str(x_int-x), 'y':str(y_int), 'width':'200', 'height':str(strap_width)} for x in (1200, 2100)]
+        return urects, rects
+
+    def getPolylines(self, points):
+        """Return point lists of the cut polylines in up and down symbols."""
+        bottom = points.bottom[1]
+        return ([points[:17], [(0,7600), (800,7600), (1800,4000), (800,400), (0,400)]],
+                [points[16:], [(0,400), (800,400), (1800,4000), (1800,bottom), (0,bottom)]])
+
+    def getLines(self, points):
+        """Return (x1, y1, x2, y2) of the fold lines in up and down symbols."""
+        lens, tab, tabEnd = points.lens, points.tab, points.tabEnd
+        bottom, depth, back, end = points.bottom, points.depth, points.back, points.end
+        return ([(0, 9000, 5800, 9000),
+                 (lens[0], lens[1]-100, tab[0], lens[1]-100),
+                 points.fold + lens,
+                 lens + tabEnd,
+                 (tabEnd[0], 9000) + tabEnd,
+                 (tabEnd[0], tabEnd[1]+100, tab[0], tabEnd[1]+100),
+                 (5800, 9000, 5800, 4000),
+                 (1800, 4000, 5800, 4000),
+                 (5800, 4000) + tabEnd,
+                 (0, 0, 5600, 0)],
+                [(0, 0, 5600, 0),
+                 (1800, 4000, 5800, 4000),
+                 (1800, bottom[1]) + bottom,
+                 bottom + depth,
+                 (0, depth[1]) + depth,
+                 (depth[0]+100, depth[1], depth[0]+100, end[1]),
+                 (back[0], back[1], back[0], end[1])])
+
+    def getSymbols(self, svg, points, side='Right', parent=None, paths=False):
+        """Add up and down side symbols to parent. With paths the polylines
+        and rects are merged into one cut path and the lines into one fold
+        path per symbol."""
+        symbols = []
+        for name, polylines, circles, rects, lines in zip(('UpSide', 'DownSide'),
+                self.getPolylines(points), self.getCircles(),
+                self.getRects(points), self.getLines(points)):
+            symbol = svg.element('symbol', parent, id=side + name)
+            if paths:
+                for attrs in rects:
+                    x0, y0 = int(attrs['x']), int(attrs['y'])
+                    x1, y1 = x0 + int(attrs['width']), y0 + int(attrs['height'])
+                    polylines.append([(x0,y0), (x1,y0), (x1,y1), (x0,y1), (x0,y0)])
+                svg.element('path', symbol, {'class':'cut', 'd':pathData(polylines)})
+                for attrs in circles:
+                    svg.element('circle', symbol, attrs)
+                svg.element('path', symbol, {'class':'fold',
+                    'd':pathData([(l[:2], l[2:]) for l in lines])})
+            else:
+                for polyline in polylines:
+                    svg.element('polyline', symbol, points=' '.join(['%s,%s'%p for p in polyline]))
+                for attrs in circles:
+                    svg.element('circle', symbol, attrs)
+                for attrs in rects:
+                    svg.element('rect', symbol, attrs)
+                for line in lines:
+                    svg.element('line', symbol, dict(zip(('x1', 'y1', 'x2', 'y2'), map(str, line))))
+            symbols.append(symbol)
+        return tuple(symbols)
+
+    def getSymbolKey(self, points, paths=False):
+        """Return hash of the geometry and style of the up and down side
+        symbols built by getSymbols from points. Symbols with the same key
+        are identical."""
+        import hashlib
+        attrs = [[sorted(a.items()) for a in symbol]
+            for symbol in self.getCircles() + self.getRects(points)]
+        return hashlib.sha1(repr((bool(paths), self.getPolylines(points),
+            attrs, self.getLines(points)))).hexdigest()[:16]
+
+    def getPages(self, rpoints, lpoints):
+        """Return attributes of page1 and page2 groups."""
+        translate = [(max(rpoints.tab[0], rpoints.strap[0])+max(lpoints.tab[0], lpoints.strap[0]))/2+50, rpoints.top[1]+50]
+        if translate[0]>self.page_width*50:
+            translate[0] = int(round(self.page_width*50)) + 50
+        pages = [{'visibility':'hidden' if self.page == 2 else 'visible', 'id':'page1', 'transform':'translate(%s,%s)'%tuple(translate)}]
+        if self.page == 2:
+            translate[1] = 50
+        pages.append({'visibility':'hidden' if self.page == 1 else 'visible', 'id':'page2', 'transform':'translate(%s,%s)'%tuple(translate)})
+        return pages
+
+    def getImage(self, rpoints):
+        """Return attributes of the logo image."""
+        return {'x':'0','y':'0','height':str(int(self.device_width*100+100)),'width':str(int(self.device_height*100+200)), 'xlink:href':logoCache.get(self.logo, self.logo_size), 'transform':'translate(%s,%s) scale(-1,-1)'%(rpoints.bottom[0],rpoints.end[1])}
+
+    def buildPage(self, svg, g, page, rpoints, sides=('Left', 'Right')):
+        """Add content of page1 (up side) or page2 (down side) group to g.
+        sides are the id prefixes of the referenced left and right symbols."""
+        left, right = sides
+        if page == 1:
+            svg.element('use', g, **{'xlink:href':'#%sUpSide'%left, 'transform':'scale(-1,-1)'})
+            svg.element('use', g, **{'xlink:href':'#%sUpSide'%right, 'transform':'scale(1,-1)'})
+        else:
+            svg.element('image', g, self.getImage(rpoints))
+            svg.element('use', g, **{'xlink:href':'#%sDownSide'%left, 'transform':'scale(-1,1)'})
+            svg.element('use', g, **{'xlink:href':'#%sDownSide'%right})
+
+    def getPageBoxes(self):
+        """Return bounding boxes (x0, y0, x1, y1) of the page1 and page2
+        groups in group coordinates."""
+        rpoints, lpoints = self.getSidePoints()
+        extents = Extents()
+        self.getSymbols(extents, rpoints)
+        self.getSymbols(extents, lpoints)
+        rup, rdown, lup, ldown = extents.boxes
+        up = (min(-lup[2], rup[0]), min(-lup[3], -rup[3]),
+              max(-lup[0], rup[2]), max(-lup[1], -rup[1]))
+        image = self.getImage(rpoints)
+        x, y = rpoints.bottom[0], rpoints.end[1]
+        w, h = int(image['width']), int(image['height'])
+        down = (min(-ldown[2], rdown[0], x-w), min(ldown[1], rdown[1], y-h),
+                max(-ldown[0], rdown[2], x), max(ldown[3], rdown[3], y))
+        return up, down
+
+    def getOutlines(self, layers=None):
+        """Return outlines of the visible pages as list of (layer, points) and
+        ('circles', (cx, cy, r)) items in page coordinates. layers are the
+        names of the returned layers (default: all of LAYERS)."""
+        rpoints, lpoints = self.getSidePoints()
+        symbols = {}
+        for side, points in (('Right', rpoints), ('Left', lpoints)):
+            lines = ([], [])
+            if layers is None or 'fold' in layers:
+                lines = self.getLines(points)
+            for name, polylines, circles, rects, lines in zip(
+                    ('UpSide', 'DownSide'), self.getPolylines(points),
+                    self.getCircles(), self.getRects(points), lines):
+                outlines = symbols[side + name] = [('cut', polyline)
+                    for polyline in polylines]
+                for attrs in circles:
+                    outlines.append(('circles', (int(attrs['cx']),
+                        int(attrs['cy']), int(attrs['r']))))
+                for attrs in rects:
+                    x0, y0 = int(attrs['x']), int(attrs['y'])
+                    x1, y1 = x0 + int(attrs['width']), y0 + int(attrs['height'])
+                    outlines.append(('cut', [(x0,y0), (x1,y0), (x1,y1),
+                        (x0,y1), (x0,y0)]))
+                for line in lines:
+                    outlines.append(('fold', (line[:2], line[2:])))
+        items = []
+        for attrs, uses in zip(self.getPages(rpoints, lpoints),
+                ((('LeftUpSide', -1, -1), ('RightUpSide', 1, -1)),
+                 (('LeftDownSide', -1, 1), ('RightDownSide', 1, 1)))):
+            if attrs['visibility'] == 'hidden':
+                continue
+            tx, ty = [int(v) for v in attrs['transform'][10:-1].split(',')]
+            for sid, sx, sy in uses:
+                for layer, data in symbols[sid]:
+                    if layers is not None and layer not in layers:
+                        continue
+                    if layer == 'circles':
+                        cx, cy, r = data
+                        data = (tx+sx*cx, ty+sy*cy, r)
+                    else:
+                        data = [(tx+sx*x, ty+sy*y) for x, y in data]
+                    items.append((layer, data))
+        return items
+
+    def checkGeometry(self):
+        """Return list of problems of the pattern on the visible pages: cut
+        outlines crossing each other, lens circles crossing cut outlines or
+        other circles and outlines exceeding the page. Candidate pairs are
+        found by a SegmentGrid spatial index. Fold lines lie inside the cut
+        outlines and are not checked."""
+        try:
+            outlines = self.getOutlines(('cut', 'circles'))
+        except ArithmeticError as e:
+            return ['Degenerate pattern geometry: %s'%e]
+        grid = SegmentGrid()
+        xs, ys = [], []
+        for number, (layer, data) in enumerate(outlines):
+            if layer == 'circles':
+                cx, cy, r = data
+                grid.add((layer, number, data), cx-r, cy-r, cx+r, cy+r)
+                xs.extend((cx-r, cx+r))
+                ys.extend((cy-r, cy+r))
+                continue
+            xs.extend([p[0] for p in data])
+            ys.extend([p[1] for p in data])
+            if layer == 'cut':
+                last = len(data) - 2
+                if data[0] != data[-1]:
+                    last = None
+                grid.addPolyline((layer, number, last), data)
+        box = min(xs), min(ys), max(xs), max(ys)
+        mm = lambda x, y: '%.2f,%.2f mm'%(x/100.0, y/100.0)
+        problems = []
+        for a, b in grid.pairs():
+            if a[0] == 'circles' and b[0] == 'circles':
+                (cx, cy, r), (dx, dy, s) = a[2], b[2]
+                if math.hypot(cx-dx, cy-dy) < r + s:
+                    problems.append('Lens circles at %s and %s overlap'%(
+                        mm(cx, cy), mm(dx, dy)))
+            elif a[0] == 'circles' or b[0] == 'circles':
+                circle, segment = a[0] == 'circles' and (a, b) or (b, a)
+                (cx, cy, r), (p, q) = circle[2], segment[3]
+                if segmentDistance((cx, cy), p, q) < r:
+                    problems.append('Lens circle at %s crosses cut outline '
+                        'from %s to %s'%(mm(cx, cy), mm(*p), mm(*q)))
+            elif a[1] != b[1] or abs(a[4] - b[4]) > 1 and (a[2] is None or
+                    sorted((a[4], b[4])) != [0, a[2]]):
+                point = segmentsCross(a[3][0], a[3][1], b[3][0], b[3][1])
+                if point is not None:
+                    problems.append('Cut outlines cross at %s'%mm(*point))
+        if (box[0] < 0 or box[1] < 0 or box[2] > self.page_width*100 or
+                box[3] > self.page_height*100):
+            problems.append('Pattern from %s to %s exceeds the page'%(
+                mm(*box[:2]), mm(*box[2:])))
+        return problems
+
+    def plot(self, writer, order=True):
+        """Stream outlines to plotter backend writer (see PLOTTERS) layer by
+        layer, which are the tools of the plotter. With order the outlines of
+        every layer are sorted by orderStrokes. Returns the pen up travel of
+        the unsorted and of the plotted outlines from the plotter origin in
+        1/100 mm."""
+        outlines = self.getOutlines()
+        start = position = (0, int(round(self.page_height*100)))
+        before = after = 0
+        for layer, color, pen in LAYERS:
+            items = [item for item in outlines if item[0] == layer]
+            travel, start = penTravel(items, start)
+            before += travel
+            if order:
+                items = orderStrokes(items, position)
+            travel, position = penTravel(items, position)
+            after += travel
+            for name, data in items:
+                if layer == 'circles':
+                    writer.circle(layer, *data)
+                else:
+                    writer.polyline(layer, data)
+        writer.close()
+        return before, after
+
+    def buildSVG(self, stream=None, pretty=True, stats=None, assets=None,
+            paths=False):
+        """Build SVG document, stream it to file-like object stream if given.
+        If assets is not None the script and stylesheet are referenced from
+        shared files (see getAssets) with assets as URL prefix instead of
+        embedding them. With paths the symbol outlines are merged into path
+        elements (see getSymbols), such document has no script, because it
+        can not be updated by it."""
+        stage = stats is None and nullStage or stats.stage
+        with stage('geometry'):
+            rpoints = self.getPoints('Right')
+            if self.getScreenMiddle() != self.device_height/2:
+                lpoints = self.getPoints('Left')
+            else:
+                lpoints = None
+        with stage('document'):
+            if stream is None:
+                svg=SVG(self.page_width, self.page_height)
+            else:
+                svg=SVGWriter(stream, self.page_width, self.page_height, pretty)
+            svg.fragment(svg.root, buildHead)
+            for name, value in self.getSVGParams():
+                svg.element('param', svg.root, name=name, value=value)
+            defs = svg.element('defs', svg.root)
+            if assets is None:
+                svg.fragment(defs, buildStyle)
+            else:
+                buildStyleLink(svg, defs, assets + getAssets()['css'][0])
+        with stage('symbols'):
+            usymbol, symbol = self.getSymbols(svg, rpoints, 'Right', defs, paths)
+            if lpoints is not None:
+                self.getSymbols(svg, lpoints, 'Left', defs, paths)
+            elif isinstance(svg, SVGWriter):
+                lpoints = rpoints
+                self.getSymbols(svg, lpoints, 'Left', defs, paths)
+            else:
+                lpoints = rpoints
+                usymbol = usymbol.cloneNode(True)
+                symbol = symbol.cloneNode(True)
+                usymbol.setAttribute('id', 'LeftUpSide')
+                symbol.setAttribute('id', 'LeftDownSide')
+                defs.appendChild(usymbol)
+                defs.appendChild(symbol)
+        with stage('document'):
+            pages = self.getPages(rpoints, lpoints)
+            g = svg.element('g', svg.root, pages[0])
+            self.buildPage(svg, g, 1, rpoints)
+            g = svg.element('g', svg.root, pages[1])
+            self.buildPage(svg, g, 2, rpoints)
+            if self.noscript or paths:
+                pass
+            elif assets is None:
+                svg.fragment(svg.root, buildScript)
+            else:
+                buildScriptLink(svg, svg.root, assets + getAssets()['js'][0])
+            if stream is not None:
+                svg.close()
+        return svg
+
+    def getSidePoints(self):
+        rpoints = self.getPoints('Right')
+        if self.getScreenMiddle() != self.device_height/2:
+            return rpoints, self.getPoints('Left')
+        return rpoints, rpoints
+
+
+class pmDive(PatternBuilder):
     """This class provides pmDive attributes and functions for generating svg file with pmDive pattern.
 
     Attributes:
@@ -421,6 +1797,8 @@ class pmDive(object):
     device_height -- the height of the smartphone in mm
     device_depth -- the depth of the smartphone in mm
     dimensions -- dimensions in form HxWxD
+    device -- device model name or alias from devices database, sets all device
+        dimensions
     device_screen_middle -- the middle of the smartphones screen (default: None if
         the middle of screen is the middle of the smartphone)
     lens_focal_length -- the focal length of the lens in mm (default: 40mm)
@@ -430,7 +1808,10 @@ class pmDive(object):
     pd -- alias for pupillary_distance
     page -- page number (1 or 2) for multipage output (default: None)
     noscript -- do not add JavaScript to target SVG file
-    logo -- logo file (in png, jpg or svg format)
+    logo -- logo file (in png, jpg or svg format) or URI, files are embedded
+        as data URI
+    logo_size -- downsample png and jpg logo files to at most logo_size pixels
+        width and height (default: None, requires PIL)
     """
 
     page_width=297
@@ -446,209 +1827,823 @@ class pmDive(object):
     page=None
     noscript=False
     logo='data:image/svg+xml;utf8,%3Csvg xmlns="http://www.w3.org/2000/svg"%3E%3Ctext x="270" y="500" font-family="Verdana" font-size="200"%3EPM%3C/text%3E%3Ctext x="100" y="700" font-family="Verdana" font-size="800"%3EDive%3C/text%3E%3C/svg%3E'
+    logo_size=None
     pd=None
     dimensions=None
+    device=None
 
     def __init__(self, **kwargs):
         for var, val in kwargs.iteritems():
             setattr(self, var, val)
 
     def __setattr__(self, name, value):
-        if name == 'dimensions':
-            values = value.lower().split('x')
-            if len(values) == 3:
-                if not (49<float(values[1])<101 and 4<float(values[2])<21):
-                    raise AttributeError("Property value out of range")
-                super(pmDive, self).__setattr__('device_width', float(values[1]))
-                super(pmDive, self).__setattr__('device_depth', float(values[2]))
-                value = values[0]
-                name = 'device_height'
-        if str(value) == 'None':
-            value = None
+        for name, value in validateParam(name, value):
+            super(pmDive, self).__setattr__(name, value)
+
+    def freeze(self):
+        """Return immutable Params with the attributes of self."""
+        params = Params.__new__(Params)
+        params.__setstate__(dict(self.getParams()))
+        return params
+
+    def updateSVG(self, svg, changes):
+        """Apply changes (dict or list of (name, value) pairs) to the attributes
+        and patch only the elements of svg (built by buildSVG() without stream)
+        which depend on the changed attributes. The result is the same as
+        from buildSVG() with the new attributes. Documents built with paths
+        are not supported."""
+        if isinstance(changes, dict):
+            changes = sorted(changes.iteritems(),
+                key=lambda c: c[0] not in ('device', 'dimensions', 'device_height'))
+        assignments = []
+        for name, value in changes:
+            assignments.extend(validateParam(name, value))
+        old = self.getParams()
+        for name, value in assignments:
+            super(pmDive, self).__setattr__(name, value)
+        actions = set()
+        for (name, value), (name, old_value) in zip(self.getParams(), old):
+            if str(value) != str(old_value):
+                actions.update(UPDATES[name])
+        if actions:
+            self.updateParams(svg)
+        for action in UPDATE_ORDER:
+            if action in actions:
+                getattr(self, action)(svg)
+        return svg
+
+    def updateParams(self, svg):
+        values = dict(self.getSVGParams())
+        for param in svg.doc.getElementsByTagName('param'):
+            param.setAttribute('value', values[param.getAttribute('name')])
+
+    def updateViewBox(self, svg):
+        svg.setPageSize(self.page_width, self.page_height)
+
+    def updateSymbols(self, svg):
+        rpoints, lpoints = self.getSidePoints()
+        nodes = svg.doc.getElementsByTagName('symbol')
+        symbols = list(self.getSymbols(svg, rpoints, 'Right'))
+        if lpoints is rpoints:
+            for symbol, sid in zip(symbols, ('LeftUpSide', 'LeftDownSide')):
+                symbols.append(symbol.cloneNode(True))
+                symbols[-1].setAttribute('id', sid)
         else:
-            value = float(value)
-        limits = {'page_width':99<value<499,
-                  'page_height':99<value<499,
-                  'device_width':49<value<101,
-                  'device_height':89<value<201,
-                  'device_depth':4<value<21,
-                  'device_screen_middle':29<value<201 or value == None,
-                  'lens_focal_length':29<value<51,
-                  'lens_diameter':19<value<31,
-                  'strap_width':19<value<47,
-                  'pupillary_distance':49<value<81,
-                  'pd':49<value<81,
-                  'page':0<value<3 or value == None,
-                  'noscript':0<value<3 or value == None,
-                  'logo':True,
-                  'dimensions':True,
-                  }
-        if name == 'pd':
-            name = 'pupillary_distance'
-        if name not in limits:
-            raise AttributeError("Incorrect property name: %s"%name)
-        if limits[name] is False:
-            raise AttributeError("Property value out of range")
-        if name == 'device_height':
-            super(pmDive, self).__setattr__('device_screen_middle', None)
-        super(pmDive, self).__setattr__(name, value)
+            symbols.extend(self.getSymbols(svg, lpoints, 'Left'))
+        for node, symbol in zip(nodes, symbols):
+            node.parentNode.replaceChild(symbol, node)
+            node.unlink()
+        self.updatePages(svg)
+        self.updateImage(svg)
 
-    def getScreenMiddle(self, side='Right'):
-        if self.device_screen_middle is None:
-            return self.device_height/2
-        if side=='Right':
-            return self.device_height-self.device_screen_middle
+    def updateCircles(self, svg):
+        ucircles, circles = self.getCircles()
+        for symbol in svg.doc.getElementsByTagName('symbol'):
+            if symbol.getAttribute('id').endswith('UpSide'):
+                attrs = ucircles
+            else:
+                attrs = circles
+            for node, attr in zip(symbol.getElementsByTagName('circle'), attrs):
+                svg.setAttributes(node, attr)
+
+    def updateStrapWidth(self, svg):
+        rpoints, lpoints = self.getSidePoints()
+        for symbol in svg.doc.getElementsByTagName('symbol'):
+            sid = symbol.getAttribute('id')
+            urects, rects = self.getRects(sid.startswith('Right') and rpoints or lpoints)
+            if sid.endswith('UpSide'):
+                attrs = urects
+            else:
+                attrs = rects
+            for node, attr in zip(symbol.getElementsByTagName('rect'), attrs):
+                svg.setAttributes(node, attr)
+
+    def updatePages(self, svg):
+        pages = self.getPages(*self.getSidePoints())
+        for node, attrs in zip(svg.doc.getElementsByTagName('g'), pages):
+            svg.setAttributes(node, attrs)
+
+    def updateImage(self, svg):
+        image = svg.doc.getElementsByTagName('image')[0]
+        svg.setAttributes(image, self.getImage(self.getPoints('Right')))
+
+    def updateScript(self, svg):
+        scripts = svg.doc.getElementsByTagName('script')
+        if self.noscript and scripts:
+            svg.root.removeChild(scripts[0]).unlink()
+        elif not self.noscript and not scripts:
+            buildScript(svg, svg.root)
+
+class Params(PatternBuilder):
+    """Immutable and hashable set of pmDive attributes. Params can be used
+    as cache key and shared between threads, it provides the same methods
+    for building the pattern as pmDive (see PatternBuilder), but not
+    updateSVG.
+
+    Params(params=(), **kwargs) -- params and kwargs are attributes in any
+    form accepted by pmDive, the other attributes have the default values.
+    """
+
+    __slots__ = PARAMS + ('_params', '_hash')
+
+    def __init__(self, params=(), **kwargs):
+        values = dict([(name, getattr(pmDive, name)) for name in PARAMS])
+        self.__setstate__(self._validate(values, params, kwargs))
+
+    def _validate(self, values, params, kwargs):
+        changes = list(params) + sorted(kwargs.iteritems(),
+            key=lambda c: c[0] not in ('device', 'dimensions', 'device_height'))
+        for name, value in changes:
+            for name, value in validateParam(name, value):
+                values[name] = value
+        return values
+
+    def with_(self, **kwargs):
+        """Return new Params with changed attributes, the other attributes are
+        taken from self without validation."""
+        params = Params.__new__(Params)
+        params.__setstate__(self._validate(dict(self._params), (), kwargs))
+        return params
+
+    def getParams(self):
+        return self._params
+
+    def __getstate__(self):
+        return dict(self._params)
+
+    def __setstate__(self, values):
+        setattr = object.__setattr__
+        for name in PARAMS:
+            setattr(self, name, values[name])
+        values['noscript'] = bool(values['noscript'])
+        setattr(self, '_params', tuple([(name, values[name]) for name in PARAMS]))
+        setattr(self, '_hash', hash(self._params))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Params are immutable")
+
+    __delattr__ = __setattr__
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        return (isinstance(other, Params) and self._hash == other._hash and
+            self.getParams() == other.getParams())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __reduce__(self):
+        return (Params, (), self.__getstate__())
+
+    def __repr__(self):
+        return 'Params(%s)'%', '.join(['%s=%r'%(name, getattr(self, name))
+            for name in PARAMS if getattr(self, name) != getattr(pmDive, name)])
+
+def fitBox(w, h, width, height, margin=100, rotate=True):
+    """Return (width, height, rotated) of box w x h with margin placed on sheet
+    of width x height, rotated by 90 degrees if that fits better and rotate is
+    True, or None if the box does not fit on the sheet."""
+    w, h = w + margin, h + margin
+    rotated = False
+    if rotate and (h > w and h <= width or w > width) and w <= height:
+        w, h, rotated = h, w, True
+    if w > width or h > height:
+        return None
+    return w, h, rotated
+
+def fillHeight(heights, height, limit=1000):
+    """Return indices of heights (sorted in decreasing order) with the largest
+    sum not exceeding height. The first height is always included (minimum
+    bin slack), at most limit combinations are tried."""
+    best = [height - heights[0], [0]]
+    tries = [limit]
+    def search(start, free, chosen):
+        if free < best[0]:
+            best[:] = [free, chosen]
+        last = None
+        for i in xrange(start, len(heights)):
+            if best[0] == 0 or tries[0] <= 0:
+                return
+            h = heights[i]
+            if h > free or h == last:
+                continue
+            last = h
+            tries[0] -= 1
+            search(i + 1, free - h, chosen + [i])
+    search(1, height - heights[0], [0])
+    return best[1]
+
+def packBoxes(sizes, width, height, margin=100, rotate=True):
+    """Pack boxes with (width, height) sizes onto as few sheets as possible.
+    The boxes are placed on shelves first fit by decreasing height, then every
+    sheet is filled with the shelves which leave the least free height (see
+    fillHeight), so shelves of different heights are mixed. Boxes may be
+    rotated by 90 degrees, if rotate is True.
+
+    Returns list of sheets, every sheet is a list of (box index, x, y, rotated)
+    tuples, where x and y are the coordinates of the upper left corner."""
+    items = []
+    for index, (w, h) in enumerate(sizes):
+        box = fitBox(w, h, width, height, margin, rotate)
+        if box is None:
+            raise ValueError("Box %s does not fit on the sheet"%index)
+        w, h, rotated = box
+        items.append((h, w, index, rotated))
+    items.sort(key=lambda item: (-item[0], -item[1]))
+    # shelves as [height, used width, [(box index, x, rotated), ...]]
+    shelves = []
+    for h, w, index, rotated in items:
+        for shelf in shelves:
+            if shelf[1] + w <= width:
+                break
         else:
-            return self.device_screen_middle
+            shelf = [h, 0, []]
+            shelves.append(shelf)
+        shelf[2].append((index, shelf[1], rotated))
+        shelf[1] += w
+    sheets = []
+    while shelves:
+        chosen = fillHeight([s[0] for s in shelves], height)
+        placed = []
+        y = 0
+        for shelf in [shelves[i] for i in chosen]:
+            for index, x, rotated in shelf[2]:
+                placed.append((index, x + margin/2, y + margin/2, rotated))
+            y += shelf[0]
+        shelves = [s for i, s in enumerate(shelves) if i not in chosen]
+        sheets.append(placed)
+    return sheets
 
-    def getPoints(self, side='Right'):
-        points = []
-        points.append((1300, int(round(((self.device_width/2-25)**2+self.lens_focal_length**2)**.5*100)) + 9000))
-        points.insert(0, (0, points[-1][1]-1200))
-        points.append((int(self.getScreenMiddle(side)*100+100), points[-1][1]))
-        points.append((5800,9000))
-        points.append(((int(round(((self.getScreenMiddle(side)-58)**2+self.lens_focal_length**2)**.5*100)))+5800, int(round((self.device_width/2-25)*100))+9000))
-        angle = math.atan((points[-1][1]-9000)/(points[-1][0]-5800.0))+math.atan(1)
-        angle1 = math.atan((points[2][1]-9000)/(points[2][0]-5800.0))
-        if abs(angle1) > angle:
-            angle1 = angle
-        points.insert(4, (int(round(5800+abs(math.cos(angle1)*1414))), int(round(abs(math.sin(angle1)*1414))) + 9000))
-        points.insert(5, (points[5][0]-int(round(abs(math.sin(angle-math.atan(1))*1000))), points[5][1]+int(round(abs(math.cos(angle-math.atan(1))*1000)))))
-        points.append((points[-1][0],points[-1][1]+1000))
-        points.append((points[-1][0]+1000,points[-1][1]))
-        points.append((points[-1][0],points[-1][1] - int(self.device_width*100) - 2000))
-        points.append((points[-1][0]-1000,points[-1][1]))
-        points.append((points[-1][0],points[-1][1]+1000))
-        points.append((points[5][0], 13000 - points[5][1]))
-        if angle > math.asin(1):
-            points.append((5800,3300))
+def packSheets(dives, page_width=297, page_height=420, margin=100,
+        rotate=True):
+    """Lay out the up and down side groups of all pmDive instances on as few
+    sheets of page_width x page_height mm as possible.
+
+    Returns list of sheets, every sheet is a list of (pmDive, page, transform)
+    tuples, where page is 1 for up side and 2 for down side group."""
+    items = []
+    for pd in dives:
+        for page, box in zip((1, 2), pd.getPageBoxes()):
+            items.append((pd, page, box))
+    sheets = []
+    for sheet in packBoxes([(x1-x0, y1-y0) for pd, page, (x0, y0, x1, y1)
+            in items], int(page_width*100), int(page_height*100), margin,
+            rotate):
+        placements = []
+        for index, x, y, rotated in sheet:
+            pd, page, (x0, y0, x1, y1) = items[index]
+            if rotated:
+                transform = 'translate(%s,%s) rotate(90)'%(x+y1, y-x0)
+            else:
+                transform = 'translate(%s,%s)'%(x-x0, y-y0)
+            placements.append((pd, page, transform))
+        sheets.append(placements)
+    return sheets
+
+def buildSheet(placements, page_width=297, page_height=420, stream=None,
+        pretty=True, paths=False):
+    """Build document with the groups of one sheet returned by packSheets.
+    Symbols are keyed by getSymbolKey and written once, all groups with the
+    same geometry reference them."""
+    if stream is None:
+        svg=SVG(page_width, page_height)
+    else:
+        svg=SVGWriter(stream, page_width, page_height, pretty)
+    svg.fragment(svg.root, buildHead)
+    defs = svg.element('defs', svg.root)
+    svg.fragment(defs, buildStyle)
+    sides = {}
+    symbols = set()
+    for pd, page, transform in placements:
+        if id(pd) in sides:
+            continue
+        sides[id(pd)] = []
+        for points in pd.getSidePoints():
+            side = 's%s'%pd.getSymbolKey(points, paths)
+            if side not in symbols:
+                symbols.add(side)
+                pd.getSymbols(svg, points, side, defs, paths)
+            sides[id(pd)].append(side)
+    for pd, page, transform in placements:
+        g = svg.element('g', svg.root, transform=transform)
+        pd.buildPage(svg, g, page, pd.getPoints('Right'), sides[id(pd)][::-1])
+    if stream is not None:
+        svg.close()
+    return svg
+
+def roundArray(numpy, values):
+    """Vectorized int(round(value)) with rounding half away from zero."""
+    a = numpy.abs(values)
+    f = numpy.floor(a)
+    return (numpy.sign(values) * (f + (a - f >= .5))).astype(numpy.int64)
+
+def getScreenMiddleArray(device_height, device_screen_middle=None,
+        side='Right'):
+    """Vectorized counterpart of pmDive.getScreenMiddle. NaN values of
+    device_screen_middle are handled as None."""
+    import numpy
+    device_height = numpy.asarray(device_height, float)
+    if device_screen_middle is None:
+        return device_height/2
+    device_screen_middle = numpy.asarray(device_screen_middle, float)
+    if side=='Right':
+        middle = device_height-device_screen_middle
+    else:
+        middle = device_screen_middle
+    return numpy.where(numpy.isnan(device_screen_middle), device_height/2,
+        middle)
+
+def getPointsArray(device_width, device_height, device_depth,
+        lens_focal_length, device_screen_middle=None, side='Right'):
+    """Vectorized counterpart of pmDive.getPoints for parameter sweeps.
+
+    All parameters are broadcasted against each other and flattened. Returns
+    integer numpy array with shape (N, 29, 2), where N is the number of
+    parameter combinations."""
+    import numpy
+    q = math.atan(1)
+    W, D, F, M = [a.ravel() for a in numpy.broadcast_arrays(
+        numpy.asarray(device_width, float), numpy.asarray(device_depth, float),
+        numpy.asarray(lens_focal_length, float),
+        getScreenMiddleArray(device_height, device_screen_middle, side))]
+    points = numpy.empty((len(W), 29, 2), numpy.int64)
+    x, y = points[:, :, 0], points[:, :, 1]
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        a = roundArray(numpy, numpy.sqrt((W/2-25)**2+F**2)*100) + 9000
+        m = (M*100+100).astype(numpy.int64)
+        b = roundArray(numpy, numpy.sqrt((M-58)**2+F**2)*100)
+        c = roundArray(numpy, (W/2-25)*100)
+        x[:, :4] = [0, 1300, 0, 5800]
+        x[:, 2] = m
+        y[:, :4] = numpy.column_stack((a-1200, a, a, a*0+9000))
+        angle = numpy.arctan(c/(b+5800-5800.0))+q
+        angle1 = numpy.arctan((a-9000)/(m-5800.0))
+        angle1 = numpy.where(numpy.abs(angle1) > angle, angle, angle1)
+        x[:, 4] = roundArray(numpy, 5800+numpy.abs(numpy.cos(angle1)*1414))
+        y[:, 4] = roundArray(numpy, numpy.abs(numpy.sin(angle1)*1414))+9000
+        x[:, 5] = b+5800-roundArray(numpy, numpy.abs(numpy.sin(angle-q)*1000))
+        y[:, 5] = c+9000+roundArray(numpy, numpy.abs(numpy.cos(angle-q)*1000))
+        x[:, 6:12] = (b+5800)[:, None] + [0, 0, 1000, 1000, 0, 0]
+        y[:, 6:9] = (c+9000)[:, None] + [0, 1000, 1000]
+        y[:, 9] = y[:, 8]-(W*100).astype(numpy.int64)-2000
+        y[:, 10:12] = y[:, 9][:, None] + [0, 1000]
+        x[:, 12] = x[:, 5]
+        y[:, 12] = 13000-y[:, 5]
+        big = angle > math.asin(1)
+        x[:, 13] = numpy.where(big, 5800, x[:, 4])
+        y[:, 13] = numpy.where(big, 3300, 13000-y[:, 4])
+        x[:, 14:19] = [5800, 5600, 5600, 5600, 5800]
+        y[:, 14:19] = [4000, 4000, 0, 4000, 4000]
+        d = roundArray(numpy, D*100+100)
+        x[:, 19] = x[:, 22] = m
+        x[:, 20] = x[:, 21] = x[:, 23] = x[:, 26] = m+d
+        y[:, 19] = y[:, 20] = roundArray(numpy,
+            numpy.sqrt((W/2-25)**2+(F-1)**2)*100)+4000
+        y[:, 21] = y[:, 22] = y[:, 23] = y[:, 19]+d
+        x[:, 24] = x[:, 25] = x[:, 23]+b
+        y[:, 24] = c+y[:, 23]
+        y[:, 25] = y[:, 24]+5000
+        y[:, 26] = y[:, 27] = y[:, 23]+roundArray(numpy, W*100+100)
+        x[:, 27:29] = [1300, 0]
+        y[:, 28] = y[:, 26]-1200
+    return points
+
+def renderQuery(query):
+    """Render pattern for URL query string like the embedded SCRIPT does with
+    the parameters (dimensions=132.6x65.5x6.18;pd=60;page=1).
+    Returns (etag, gzip compressed body) from responseCache."""
+    import urlparse, hashlib, StringIO
+    params = []
+    for name, value in urlparse.parse_qsl(query, True):
+        if name == 'noscript' and not value:
+            value = True
+        if name == 'logo' and os.path.exists(value):
+            raise ValueError("Logo files are not allowed")
+        params.append((name, value))
+    pd = key = Params(params)
+    response = responseCache.get(key)
+    if response is None:
+        f = StringIO.StringIO()
+        gz = openOutput('', True, f)
+        pd.buildSVG(gz)
+        gz.close()
+        body = f.getvalue()
+        response = ('"%s"'%hashlib.sha1(body).hexdigest(), body)
+        responseCache.set(key, response)
+    return response
+
+def serve(address=('', 8000)):
+    """Serve patterns over HTTP, every request is handled in its own thread."""
+    import BaseHTTPServer, SocketServer
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            try:
+                etag, body = renderQuery(self.path.partition('?')[2])
+            except (AttributeError, ValueError, TypeError,
+                    ArithmeticError) as e:
+                # invalid parameters or degenerate geometry
+                self.send_error(400, str(e))
+                return
+            except Exception as e:
+                self.log_error('%s failed: %r', self.path, e)
+                self.send_error(500, str(e))
+                return
+            gzipped = 'gzip' in self.headers.get('Accept-Encoding', '')
+            if not gzipped:
+                etag = etag[:-1] + '-identity"'
+            if etag in self.headers.get('If-None-Match', ''):
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/svg+xml')
+            self.send_header('ETag', etag)
+            self.send_header('Vary', 'Accept-Encoding')
+            if gzipped:
+                self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if self.command == 'HEAD':
+                return
+            if gzipped:
+                self.wfile.write(body)
+                return
+            import gzip, StringIO
+            f = gzip.GzipFile(fileobj=StringIO.StringIO(body))
+            for chunk in iter(lambda: f.read(16384), ''):
+                self.wfile.write(chunk)
+
+        do_HEAD = do_GET
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    Server(address, Handler).serve_forever()
+
+@contextmanager
+def atomicOutput(filename):
+    """Yield temporary file in the directory of filename, which replaces
+    filename if the block succeeds and is removed otherwise. So failed jobs
+    leave no partial output and files hard linked to filename (see
+    OutputCache) are never modified."""
+    import tempfile
+    directory, name = os.path.split(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp('.tmp', name + '.', directory)
+    os.close(fd)
+    try:
+        f = open(tmp, 'wb')
+        try:
+            yield f
+        finally:
+            f.close()
+        os.chmod(tmp, 0644)
+        os.rename(tmp, filename)
+        if os.path.lexists(tmp):
+            # rename does nothing if filename is a link to the same file
+            os.remove(tmp)
+    except:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        raise
+
+def openOutput(filename, compress=None, fileobj=None):
+    """Open output file (or wrap file object fileobj), gzip compressed if
+    compress is True or None and the file name ends with .svgz."""
+    if compress is None:
+        compress = filename.lower().endswith('.svgz')
+    if not compress:
+        return fileobj is None and open(filename, 'w+') or fileobj
+    import gzip
+    return gzip.GzipFile(filename, 'wb', 9, fileobj, 0)
+
+def writeSVG(pd, filename, pretty=True, stats=None, compress=None,
+        assets=None, paths=False):
+    with atomicOutput(filename) as fileobj:
+        f = openOutput(filename, compress, fileobj)
+        try:
+            pd.buildSVG(f, pretty, stats, assets, paths)
+        finally:
+            f.close()
+
+def writePlot(pd, filename, writer=None):
+    """Write outlines for cutting plotters, the backend is chosen by the
+    file extension if writer is not given. Returns pen up travel before and
+    after ordering (see pmDive.plot)."""
+    if writer is None:
+        writer = PLOTTERS[os.path.splitext(filename)[1].lower()]
+    with atomicOutput(filename) as f:
+        return pd.plot(writer(f, pd.page_width, pd.page_height))
+
+class OutputCache(object):
+    """Content-addressed on-disk cache of generated files. The key is a hash of
+    the normalized pmDive attributes, the logo file content, the output format
+    and the module version. Files are written atomically and the least
+    recently used files are removed when the total size exceeds maxsize
+    bytes."""
+
+    def __init__(self, directory, maxsize=512*1024*1024, link=True):
+        self.directory = directory
+        self.maxsize = maxsize
+        self.link = link
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.size = sum([size for path, size, mtime in self.files()])
+
+    def files(self):
+        for name in os.listdir(self.directory):
+            if name.endswith('.svg') or name.endswith('.svgz'):
+                path = os.path.join(self.directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield path, st.st_size, st.st_mtime
+
+    def key(self, pd, pretty=True, compress=False, assets=None, paths=False):
+        import hashlib
+        h = hashlib.sha1(repr((__version__, pretty, assets, bool(paths),
+            pd.getParams())))
+        if pd.logo and os.path.isfile(pd.logo):
+            f = open(pd.logo, 'rb')
+            h.update(f.read())
+            f.close()
+        return h.hexdigest() + (compress and '.svgz' or '.svg')
+
+    def get(self, key):
+        """Return path of cached file or None."""
+        path = os.path.join(self.directory, key)
+        try:
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def put(self, key, pd, pretty=True, assets=None, paths=False):
+        path = os.path.join(self.directory, key)
+        with atomicOutput(path) as f:
+            if key.endswith('.svgz'):
+                gz = openOutput('', True, f)
+                pd.buildSVG(gz, pretty, None, assets, paths)
+                gz.close()
+            else:
+                pd.buildSVG(f, pretty, None, assets, paths)
+        self.size += os.path.getsize(path)
+        return path
+
+    def evict(self):
+        files = sorted(self.files(), key=lambda f: f[2])
+        self.size = sum([size for path, size, mtime in files])
+        for path, size, mtime in files:
+            if self.size <= self.maxsize:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
+
+    def write(self, pd, filename, pretty=True, compress=None, assets=None,
+            paths=False):
+        """Write pattern to filename, hard link or copy cached file if
+        possible. Returns True on cache hit."""
+        if compress is None:
+            compress = filename.lower().endswith('.svgz')
+        key = self.key(pd, pretty, compress, assets, paths)
+        path = self.get(key)
+        hit = path is not None
+        if not hit:
+            path = self.put(key, pd, pretty, assets, paths)
+        try:
+            if not self.link:
+                raise OSError
+            with atomicOutput(filename) as f:
+                # replace the temporary file by a link to the cached file
+                os.remove(f.name)
+                os.link(path, f.name)
+        except (OSError, AttributeError):
+            import shutil
+            with atomicOutput(filename) as f:
+                source = open(path, 'rb')
+                try:
+                    shutil.copyfileobj(source, f)
+                finally:
+                    source.close()
+        if self.size > self.maxsize:
+            self.evict()
+        return hit
+
+outputCaches = {}
+
+def getOutputCache(directory, maxsize=512*1024*1024):
+    """Return OutputCache shared by all jobs of the process."""
+    key = (directory, maxsize)
+    if key not in outputCaches:
+        outputCaches[key] = OutputCache(directory, maxsize)
+    return outputCaches[key]
+
+def readCatalog(filename):
+    """Read catalog of parameter sets from CSV (with header line) or JSON-lines
+    file. Every job is returned as list of (name, value) pairs in file order,
+    because order of assignment matters for pmDive attributes. Lines which
+    can not be decoded are returned as ValueError, which fails the job."""
+    f = open(filename, 'rb')
+    try:
+        if os.path.splitext(filename)[1].lower() == '.csv':
+            import csv
+            reader = csv.reader(f)
+            header = [h.strip() for h in reader.next()]
+            for row in reader:
+                if row:
+                    yield zip(header, [v.strip() for v in row])
         else:
-            points.append((points[4][0], 13000 - points[4][1]))
-        points.append((5800,4000))
-        points.append((5600,4000))
-        points.append((5600,0))
-        points.append((5600,4000))
-        points.append((5800,4000))
-        points.append((int(self.getScreenMiddle(side)*100+100), int(round(((self.device_width/2-25)**2+(self.lens_focal_length-1)**2)**.5*100))+points[-1][1]))
-        points.append((points[-1][0]+int(round(self.device_depth*100+100)), points[-1][1]))
-        points.append((points[-1][0],points[-1][1]+int(round(self.device_depth*100+100))))
-        points.append((points[-3][0], points[-1][1]))
-        points.append((points[-3][0], points[-1][1]))
-        points.append((points[-1][0] + int(round(((self.getScreenMiddle(side)-58)**2+self.lens_focal_length**2)**.5*100)), int(round((self.device_width/2-25)*100))+points[-1][1]))
-        points.append((points[-1][0],points[-1][1]+5000))
-        points.append((points[-3][0],points[-3][1]+int(round(self.device_width*100+100))))
-        points.append((1300,points[-1][1]))
-        points.append((0,points[-2][1]-1200))
-        return points
+            import json
+            for number, line in enumerate(f):
+                if not line.strip():
+                    continue
+                try:
+                    job = json.loads(line, object_pairs_hook=list)
+                except ValueError as e:
+                    job = ValueError("line %s: %s"%(number + 1, e))
+                if isinstance(job, list) and [pair for pair in job
+                        if not isinstance(pair, (list, tuple)) or len(pair) != 2]:
+                    job = None
+                if not isinstance(job, (list, ValueError)):
+                    job = ValueError("line %s: job is not an object"%(number + 1))
+                yield job
+    finally:
+        f.close()
 
-    def getSymbols(self, svg, points):
-        cx_int = int(round(self.pupillary_distance*50))
-        r_int = int(round(self.lens_diameter*50))
-        strap_width=int(self.strap_width*100+200)
-        usymbol = svg.element('symbol', None, id='RightUpSide')
-        svg.element('polyline', usymbol, points=' '.join(['%s,%s'%p for p in points[:17]]))
-        svg.element('polyline', usymbol, points='0,7600 800,7600 1800,4000 800,400 0,400')
-        svg.element('circle', usymbol, cx=str(cx_int), cy='6500', r=str(r_int-200))
-        svg.element('circle', usymbol, cx=str(cx_int), cy='1500', r=str(r_int))
-        y_int=int(round(6500 - strap_width/2))
-        svg.element('rect', usymbol, x='5600', y=str(y_int), width='200', height=str(strap_width))
-        svg.element('rect', usymbol, x='6800', y=str(y_int), width='200', height=str(strap_width))
-        svg.element('rect', usymbol, x='7800', y=str(y_int), width='200', height=str(strap_width))
-        svg.element('line', usymbol, x1='0', y1='9000', x2='5800', y2='9000')
-        svg.element('line', usymbol, x1=str(points[6][0]), y1=str(points[6][1]-100), x2=str(points[8][0]), y2=str(points[6][1]-100))
-        svg.element('line', usymbol, x1=str(points[3][0]), y1=str(points[3][1]), x2=str(points[6][0]), y2=str(points[6][1]))
-        svg.element('line', usymbol, x1=str(points[6][0]), y1=str(points[6][1]), x2=str(points[11][0]), y2=str(points[11][1]))
-        svg.element('line', usymbol, x1=str(points[11][0]), y1='9000', x2=str(points[11][0]), y2=str(points[11][1]))
-        svg.element('line', usymbol, x1=str(points[11][0]), y1=str(points[11][1]+100), x2=str(points[8][0]), y2=str(points[11][1]+100))
-        svg.element('line', usymbol, x1='5800', y1='9000', x2='5800', y2='4000')
-        svg.element('line', usymbol, x1='1800', y1='4000', x2='5800', y2='4000')
-        svg.element('line', usymbol, x1='5800', y1='4000', x2=str(points[11][0]), y2=str(points[11][1]))
-        svg.element('line', usymbol, x1='0', y1='0', x2='5600', y2='0')
-        symbol = svg.element('symbol', None, id='RightDownSide')
-        svg.element('polyline', symbol, points=' '.join(['%s,%s'%p for p in points[16:]]))
-        svg.element('polyline', symbol, points='0,400 800,400 1800,4000 1800,%s 0,%s'%(str(points[19][1]),str(points[19][1])))
-        svg.element('circle', symbol, cx=str(cx_int), cy='1500', r=str(r_int-200))
-        y_int=int(round(((points[25][1]-points[24][1])-strap_width)/2)+points[24][1])
-        svg.element('rect', symbol, x=str(points[24][0]-1200), y=str(y_int), width='200', height=str(strap_width))
-        svg.element('rect', symbol, x=str(points[24][0]-2100), y=str(y_int), width='200', height=str(strap_width))
-        svg.element('line', symbol, x1='0', y1='0', x2='5600', y2='0')
-        svg.element('line', symbol, x1='1800', y1='4000', x2='5800', y2='4000')
-        svg.element('line', symbol, x1='1800', y1=str(points[19][1]), x2=str(points[19][0]), y2=str(points[19][1]))
-        svg.element('line', symbol, x1=str(points[19][0]), y1=str(points[19][1]), x2=str(points[22][0]), y2=str(points[22][1]))
-        svg.element('line', symbol, x1='0', y1=str(points[22][1]), x2=str(points[22][0]), y2=str(points[22][1]))
-        svg.element('line', symbol, x1=str(points[22][0]+100), y1=str(points[22][1]), x2=str(points[22][0]+100), y2=str(points[26][1]))
-        svg.element('line', symbol, x1=str(points[23][0]), y1=str(points[23][1]), x2=str(points[23][0]), y2=str(points[26][1]))
-        return usymbol, symbol
-
-    def buildSVG(self):
-        svg=SVG(self.page_width, self.page_height)
-        svg.textNode('title', "Poor Man's Dive", svg.root)
-        svg.textNode('desc', "Poor Man's Dive is a pattern for paper model of OpenDive (http://www.durovis.com/opendive.html) compatible 3D glasses.", svg.root)
-        metadata = svg.element('metadata', svg.root)
-        rdfRDF = svg.element('rdf:RDF', metadata, attributes={"xmlns:rdf":"http://www.w3.org/1999/02/22-rdf-syntax-ns#","xmlns:cc":"http://creativecommons.org/ns#"})
-        ccWork = svg.element('cc:Work', rdfRDF, attributes={"xmlns:dc":"http://purl.org/dc/elements/1.1/","rdf:about":""})
-        svg.textNode('dc:format', "image/svg+xml", ccWork)
-        svg.element('dc:type', ccWork, attributes={"rdf:resource":"http://purl.org/dc/dcmitype/StillImage"})
-        svg.textNode('dc:creator', "Egor Puzanov", ccWork)
-        svg.element('dc:license', ccWork, attributes={"rdf:resource":"http://creativecommons.org/licenses/by-sa/3.0/"})
-        svg.element('cc:license', ccWork, attributes={"rdf:resource":"http://creativecommons.org/licenses/by-sa/3.0/"})
-        svg.textNode('cc:attributionName', "Egor Puzanov", ccWork)
-        ccLicense = svg.element('cc:License', rdfRDF, attributes={"rdf:about":"http://creativecommons.org/licenses/by-sa/3.0/"})
-        svg.element('cc:permits', ccLicense, attributes={"rdf:resource":"http://creativecommons.org/ns#Reproduction"})
-        svg.element('cc:permits', ccLicense, attributes={"rdf:resource":"http://creativecommons.org/ns#Distribution"})
-        svg.element('cc:requires', ccLicense, attributes={"rdf:resource":"http://creativecommons.org/ns#Notice"})
-        svg.element('cc:requires', ccLicense, attributes={"rdf:resource":"http://creativecommons.org/ns#Attribution"})
-        svg.element('cc:permits', ccLicense, attributes={"rdf:resource":"http://creativecommons.org/ns#DerivativeWorks"})
-        svg.element('cc:requires', ccLicense, attributes={"rdf:resource":"http://creativecommons.org/ns#ShareAlike"})
-        svg.element('param', svg.root, name="page_width", value=str(self.page_width))
-        svg.element('param', svg.root, name="page_height", value=str(self.page_height))
-        svg.element('param', svg.root, name="device_width", value=str(self.device_width))
-        svg.element('param', svg.root, name="device_height", value=str(self.device_height))
-        svg.element('param', svg.root, name="device_depth", value=str(self.device_depth))
-        svg.element('param', svg.root, name="device_screen_middle", value=str(self.device_screen_middle or ""))
-        svg.element('param', svg.root, name="lens_focal_length", value=str(self.lens_focal_length))
-        svg.element('param', svg.root, name="lens_diameter", value=str(self.lens_diameter))
-        svg.element('param', svg.root, name="pupillary_distance", value=str(self.pupillary_distance))
-        svg.element('param', svg.root, name="strap_width", value=str(self.strap_width))
-        svg.element('param', svg.root, name="page", value=str(self.page or ""))
-        defs = svg.element('defs', svg.root)
-        style = svg.element('style', defs, type='text/css')
-        style.appendChild(svg.doc.createCDATASection(STYLE))
-        rpoints = self.getPoints('Right')
-        usymbol, symbol = self.getSymbols(svg, rpoints)
-        defs.appendChild(usymbol)
-        defs.appendChild(symbol)
-        if self.getScreenMiddle() != self.device_height/2:
-            lpoints = self.getPoints('Left')
-            usymbol, symbol = self.getSymbols(svg, lpoints)
+# catalog job fields which are not pmDive attributes
+JOBOPTS = ('output', 'compact', 'compress', 'assets', 'paths', 'cache',
+    'cache_size', 'check')
+
+def writeOutput(pd, filename, opts, stats=None):
+    """Write pattern according to job options (compact, compress, assets,
+    paths, cache, cache_size in MB, check). With assets the shared script and
+    stylesheet are written next to the output file. Files with extension of
+    PLOTTERS are written by writePlot, then the pen up travel before and after
+    ordering is returned. With check ValueError is raised before
+    rendering if checkGeometry finds problems."""
+    if opts.get('check'):
+        problems = pd.checkGeometry()
+        if problems:
+            raise ValueError('; '.join(problems))
+    if os.path.splitext(filename)[1].lower() in PLOTTERS:
+        return writePlot(pd, filename)
+    pretty = not opts.get('compact')
+    compress = opts.get('compress') and True or None
+    paths = bool(opts.get('paths'))
+    assets = None
+    if opts.get('assets'):
+        assets = ''
+        writeAssets(os.path.dirname(filename))
+    if opts.get('cache'):
+        getOutputCache(opts['cache'], int(opts.get('cache_size') or 512)
+            * 1024 * 1024).write(pd, filename, pretty, compress, assets,
+            paths)
+    else:
+        writeSVG(pd, filename, pretty, stats, compress, assets, paths)
+
+def renderJob(job):
+    """Render one catalog job and return (output, error message or None).
+    Jobs which could not be read (see readCatalog) are exceptions, their
+    output is None."""
+    output = None
+    try:
+        if isinstance(job, Exception):
+            raise job
+        opts = dict([(n, v) for n, v in job if n in JOBOPTS])
+        output = opts.get('output', 'pmdive.svg')
+        pd = pmDive()
+        for name, value in job:
+            if name not in opts and value != '':
+                setattr(pd, name, value)
+        writeOutput(pd, output, opts)
+    except (AttributeError, ValueError, TypeError, ArithmeticError,
+            ImportError, EnvironmentError) as e:
+        return output, str(e)
+    return output, None
+
+def runWorker(infile, outfile, defaults=()):
+    """Render one job per line of infile until end of file. A job is a JSON
+    object with the command line options (without --) and an output field.
+    After every job a JSON status line with output path, bytes and elapsed ms
+    (or error message) is written to outfile.
+
+    defaults -- (name, value) pairs applied before every job"""
+    import copy, json
+    base = pmDive()
+    options = {}
+    for name, value in defaults:
+        if name in JOBOPTS:
+            options[name] = value
         else:
-            lpoints = rpoints
-            usymbol = usymbol.cloneNode(True)
-            symbol = symbol.cloneNode(True)
-        usymbol.setAttribute('id', 'LeftUpSide')
-        symbol.setAttribute('id', 'LeftDownSide')
-        defs.appendChild(usymbol)
-        defs.appendChild(symbol)
-        translate = [(max(rpoints[8][0], rpoints[24][0])+max(lpoints[8][0], lpoints[24][0]))/2+50, rpoints[1][1]+50]
-        if translate[0]>self.page_width*50:
-            translate[0] = int(round(self.page_width*50)) + 50
-        g = svg.element('g', svg.root, visibility='hidden' if self.page == 2 else 'visible', id='page1', transform='translate(%s,%s)'%tuple(translate))
-        svg.element('use', g, **{'xlink:href':'#LeftUpSide', 'transform':'scale(-1,-1)'})
-        svg.element('use', g, **{'xlink:href':'#RightUpSide', 'transform':'scale(1,-1)'})
-        if self.page == 2:
-            translate[1] = 50
-        g = svg.element('g', svg.root, visibility='hidden' if self.page == 1 else 'visible', id='page2', transform='translate(%s,%s)'%tuple(translate))
-        svg.element('image', g, **{'x':'0','y':'0','height':str(int(self.device_width*100+100)),'width':str(int(self.device_height*100+200)), 'xlink:href':self.logo, 'transform':'translate(%s,%s) scale(-1,-1)'%(rpoints[19][0],rpoints[26][1])})
-        svg.element('use', g, **{'xlink:href':'#LeftDownSide', 'transform':'scale(-1,1)'})
-        svg.element('use', g, **{'xlink:href':'#RightDownSide'})
-        if not self.noscript:
-            script = svg.element('script', svg.root, type='application/ecmascript')
-            script.appendChild(svg.doc.createCDATASection(SCRIPT))
-        return svg
+            setattr(base, name, value)
+    for line in iter(infile.readline, ''):
+        if not line.strip():
+            continue
+        start = timeit.default_timer()
+        status = {'output':None, 'bytes':None, 'error':None}
+        try:
+            job = [(name.lstrip('-'), value)
+                for name, value in json.loads(line, object_pairs_hook=list)]
+            opts = dict(options)
+            opts.update([(n, v) for n, v in job if n in JOBOPTS])
+            status['output'] = output = opts.get('output', 'pmdive.svg')
+            pd = copy.copy(base)
+            for name, value in job:
+                if name not in JOBOPTS and value != '':
+                    setattr(pd, name, value)
+            travel = writeOutput(pd, output, opts)
+            status['bytes'] = os.path.getsize(output)
+            if travel is not None:
+                status['travel'] = round(travel[1]/100, 1)
+        except (AttributeError, ValueError, TypeError, ArithmeticError,
+                ImportError, EnvironmentError) as e:
+            status['error'] = str(e)
+        status['ms'] = round((timeit.default_timer() - start) * 1000, 3)
+        outfile.write(json.dumps(status, sort_keys=True) + '\n')
+        outfile.flush()
+
+def buildCatalog(jobs, defaults=(), processes=None, chunksize=16):
+    """Render all catalog jobs in a process pool.
+
+    jobs -- iterable of jobs as returned by readCatalog
+    defaults -- (name, value) pairs applied before every job
+    processes -- number of worker processes (default: number of CPUs)
+    chunksize -- number of jobs sent to a worker at once
+
+    Returns list of (output, error message) pairs for failed jobs, output is
+    None for jobs which could not be read."""
+    jobs = (isinstance(job, Exception) and job or list(defaults) + list(job)
+        for job in jobs)
+    if processes == 1:
+        results = map(renderJob, jobs)
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = list(pool.imap_unordered(renderJob, jobs, chunksize))
+        finally:
+            pool.close()
+            pool.join()
+    return [(output, error) for output, error in results if error]
+
+def buildCatalogSheets(jobs, defaults=(), filename='sheet%s.svg', pretty=True,
+        compress=None, paths=False):
+    """Pack patterns of all catalog jobs onto sheets of the page size given
+    by defaults and write them to filename % sheet number. Output fields of the
+    jobs are ignored.
+
+    Returns list of (job number, error message) pairs for failed jobs."""
+    page = pmDive()
+    failed = []
+    dives = []
+    for name, value in defaults:
+        if name not in JOBOPTS:
+            setattr(page, name, value)
+    for number, job in enumerate(jobs):
+        pd = pmDive()
+        try:
+            if isinstance(job, Exception):
+                raise job
+            for name, value in list(defaults) + list(job):
+                if name not in JOBOPTS and value != '':
+                    setattr(pd, name, value)
+            for x0, y0, x1, y1 in pd.getPageBoxes():
+                if fitBox(x1-x0, y1-y0, int(page.page_width*100),
+                        int(page.page_height*100)) is None:
+                    raise ValueError("Pattern does not fit on the sheet")
+            if dict(defaults).get('check'):
+                problems = pd.checkGeometry()
+                if problems:
+                    raise ValueError('; '.join(problems))
+        except (AttributeError, ValueError, TypeError, ArithmeticError) as e:
+            failed.append((number + 1, str(e)))
+            continue
+        dives.append(pd)
+    for number, sheet in enumerate(packSheets(dives, page.page_width,
+            page.page_height)):
+        with atomicOutput(filename%(number + 1)) as fileobj:
+            f = openOutput(filename%(number + 1), compress, fileobj)
+            try:
+                buildSheet(sheet, page.page_width, page.page_height, f, pretty,
+                    paths)
+            finally:
+                f.close()
+    return failed
 
 if __name__ == '__main__':
     import sys, getopt
-    lopts = ['help', 'noscript']
+    lopts = ['help', 'noscript', 'compact', 'compress', 'assets', 'paths',
+        'catalog=', 'processes=', 'chunksize=', 'serve=', 'profile',
+        'profile_dump=', 'cache=', 'cache_size=', 'sheets=', 'worker',
+        'logo_cache=', 'check']
     for attr, val in pmDive.__dict__.iteritems():
         if attr.startswith('__') or callable(val) or attr in lopts: continue
         lopts.append('%s='%attr)
@@ -658,16 +2653,73 @@ if __name__ == '__main__':
         print __doc__
         sys.exit(2)
     pd = pmDive()
+    params = []
+    options = {}
     for opt, arg in opts:
         if opt in ("-h", "--help"):
             print pd.__doc__
             sys.exit()
+        if opt in ("--compact", "--compress", "--assets", "--paths",
+                "--check"):
+            options[opt[2:]] = arg = True
+            params.append((opt[2:], arg))
+            continue
+        if opt in ("--cache", "--cache_size"):
+            options[opt[2:]] = arg
+            params.append((opt[2:], arg))
+            continue
+        if opt in ("--catalog", "--processes", "--chunksize", "--serve",
+                "--profile", "--profile_dump", "--sheets", "--worker",
+                "--logo_cache"):
+            options[opt[2:]] = arg
+            continue
         if opt == "--noscript":
             arg = True
-        setattr(pd, opt[2:], arg)
+        params.append((opt[2:], arg))
+    stats = None
+    if 'profile' in options or 'profile_dump' in options:
+        stats = Stats()
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    with (stats is None and nullStage or stats.stage)('validation'):
+        for name, value in params:
+            if name not in JOBOPTS:
+                setattr(pd, name, value)
+    if 'logo_cache' in options:
+        logoCache.directory = options['logo_cache']
+    if 'serve' in options:
+        host, _, port = options['serve'].rpartition(':')
+        serve((host, int(port)))
+    if 'worker' in options:
+        runWorker(sys.stdin, sys.stdout, params)
+        sys.exit()
+    if 'catalog' in options and 'sheets' in options:
+        failed = buildCatalogSheets(readCatalog(options['catalog']), params,
+            options['sheets'], not options.get('compact'),
+            options.get('compress'), options.get('paths'))
+        for number, error in failed:
+            sys.stderr.write('job %s: %s\n'%(number, error))
+        sys.exit(failed and 1 or 0)
+    if 'catalog' in options:
+        failed = buildCatalog(readCatalog(options['catalog']), params,
+            int(options.get('processes', 0)) or None,
+            int(options.get('chunksize', 16)))
+        for output, error in failed:
+            sys.stderr.write('%s: %s\n'%(output or options['catalog'], error))
+        sys.exit(failed and 1 or 0)
     if not args:
         args.append('pmdive.svg')
-    d=pd.buildSVG()
-    f = open(args[0], 'w+')
-    f.write(d.doc.toprettyxml())
-    f.close()
+    try:
+        travel = writeOutput(pd, args[0], options, stats)
+    except ValueError as e:
+        sys.stderr.write('%s: %s\n'%(args[0], e))
+        sys.exit(1)
+    if travel is not None:
+        print 'pen up travel: %.1f mm (unordered: %.1f mm)'%(travel[1]/100,
+            travel[0]/100)
+    if stats is not None:
+        profiler.disable()
+        print stats.report()
+        if 'profile_dump' in options:
+            profiler.dump_stats(options['profile_dump'])